@@ -0,0 +1,351 @@
+"""Export and import of a user's permanent values as an encrypted archive.
+
+Rows are exported as they are stored, still encrypted with the user key,
+together with the user's UserSecureBox and the chunks of their blobs. The
+archive as a whole is encrypted with a caller supplied key using libsodium's
+secretstream, so neither exporting nor importing needs the user's password.
+An imported box opens with the password it was exported with, as long as
+the user's password hash is the same (the KDF salt is derived from it).
+
+The archive is ``MAGIC``, which includes the format version, the
+secretstream header and a sequence of messages, each prefixed with its
+length as a 4-byte big-endian integer. Each message is a record: its kind
+followed by its fields as listed in ``FIELDS``. Strings and bytes are
+length-prefixed like messages, numbers and flags are packed with struct.
+The records are:
+
+``('box', user_key, public_key, private_key, opslimit, memlimit)``
+    The wrapped key material, always the first record.
+``('value', name, object_key, sealed, expires_at, data)``
+    One SecureObjectLink with its SecureObject, expires_at is a POSIX
+    timestamp or None. Expired values are not exported.
+``('blob', header)``, ``('chunk', data)``
+    A blob of the preceding value and its chunks, in order.
+``('end',)``
+    The last message, tagged final, so truncated archives are detected.
+
+Both directions stream from ``.iterator()`` querysets and batched writes, so
+memory use doesn't depend on the size of the box.
+"""
+
+import struct
+from datetime import datetime
+
+import nacl.bindings
+import nacl.encoding
+import nacl.exceptions
+from django.db import connection, transaction
+from django.utils import timezone
+
+from django_securebox import cache
+from django_securebox.utils import SecureBoxException
+
+MAGIC = b'SECUREBOX2'
+KEY_SIZE = nacl.bindings.crypto_secretstream_xchacha20poly1305_KEYBYTES
+HEADER_SIZE = nacl.bindings.crypto_secretstream_xchacha20poly1305_HEADERBYTES
+LENGTH = struct.Struct('>I')
+BLOB_BATCH_BYTES = 1024 * 1024
+
+# Field types: b bytes, s str, ? bool, Q unsigned 64-bit integer, t POSIX timestamp or None
+FIELDS = {
+    'box': 'bbbQQ',
+    'value': 'sb?tb',
+    'blob': 'b',
+    'chunk': 'b',
+    'end': '',
+}
+_BOOL = struct.Struct('>?')
+_UINT = struct.Struct('>Q')
+_TIMESTAMP = struct.Struct('>?d')
+
+
+def load_key(path):
+    """Archive key from a file holding it base64 encoded."""
+    with open(path) as f:
+        key = nacl.encoding.Base64Encoder.decode(f.read().strip())
+    if len(key) != KEY_SIZE:
+        raise ValueError('Archive keys are {} bytes'.format(KEY_SIZE))
+    return key
+
+
+def _encode_bytes(value):
+    return LENGTH.pack(len(value)) + value
+
+
+def encode_record(record):
+    kind, *values = record
+    parts = [_encode_bytes(kind.encode('ascii'))]
+    for field, value in zip(FIELDS[kind], values):
+        if field == 'b':
+            parts.append(_encode_bytes(value))
+        elif field == 's':
+            parts.append(_encode_bytes(value.encode('utf-8')))
+        elif field == '?':
+            parts.append(_BOOL.pack(value))
+        elif field == 'Q':
+            parts.append(_UINT.pack(value))
+        else:
+            parts.append(_TIMESTAMP.pack(value is not None, value or 0.0))
+    return b''.join(parts)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise SecureBoxException('Archive record is truncated')
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.read(fmt.size))
+
+    def read_bytes(self):
+        length, = self.unpack(LENGTH)
+        return self.read(length).tobytes()
+
+
+def decode_record(data):
+    reader = _Reader(data)
+    kind = reader.read_bytes().decode('ascii', errors='replace')
+    if kind not in FIELDS:
+        raise SecureBoxException('Unknown archive record {!r}'.format(kind))
+
+    record = [kind]
+    for field in FIELDS[kind]:
+        if field == 'b':
+            record.append(reader.read_bytes())
+        elif field == 's':
+            record.append(reader.read_bytes().decode('utf-8'))
+        elif field == '?':
+            record.append(reader.unpack(_BOOL)[0])
+        elif field == 'Q':
+            record.append(reader.unpack(_UINT)[0])
+        else:
+            present, timestamp = reader.unpack(_TIMESTAMP)
+            record.append(timestamp if present else None)
+    if reader.offset != len(reader.data):
+        raise SecureBoxException('Archive record {!r} has trailing data'.format(kind))
+    return tuple(record)
+
+
+def _records(user_id, chunk_size):
+    from .models import SecureBlobChunk, SecureObjectLink, UserSecureBox
+
+    userbox = UserSecureBox.objects.filter(user_id=user_id).first()
+    if userbox is None:
+        return
+    yield ('box', bytes(userbox._user_key), bytes(userbox.public_key), bytes(userbox._private_key),
+           userbox.kdf_opslimit, userbox.kdf_memlimit)
+
+    links = SecureObjectLink.objects.filter(
+        user_id=user_id,
+    ).exclude(
+        expires_at__lte=timezone.now(),
+    ).order_by('obj_id').values_list('obj_id', 'name', 'object_key', 'sealed', 'expires_at', 'obj__data')
+    # Both querysets are ordered by object, so blobs are merged in without a query per value
+    chunks = SecureBlobChunk.objects.filter(
+        blob__obj__links__user_id=user_id,
+    ).order_by('blob__obj_id', 'blob_id', 'index').values_list('blob__obj_id', 'blob_id', 'blob__header', 'data')
+    chunks = chunks.iterator(chunk_size=chunk_size)
+    chunk = next(chunks, None)
+
+    for obj_id, name, object_key, sealed, expires_at, data in links.iterator(chunk_size=chunk_size):
+        yield ('value', name, bytes(object_key), sealed, expires_at and expires_at.timestamp(), bytes(data))
+
+        blob_id = None
+        while chunk is not None and chunk[0] <= obj_id:
+            if chunk[0] == obj_id:
+                if chunk[1] != blob_id:
+                    blob_id = chunk[1]
+                    yield ('blob', bytes(chunk[2]))
+                yield ('chunk', bytes(chunk[3]))
+            chunk = next(chunks, None)
+
+
+def export_user(user_id, key, chunk_size=1000):
+    """Yield the archive of the user's permanent values, encrypted with key."""
+    state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+    yield MAGIC + nacl.bindings.crypto_secretstream_xchacha20poly1305_init_push(state, key)
+
+    def message(record, tag=nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE):
+        data = nacl.bindings.crypto_secretstream_xchacha20poly1305_push(state, encode_record(record), tag=tag)
+        return LENGTH.pack(len(data)) + data
+
+    for record in _records(user_id, chunk_size):
+        yield message(record)
+    yield message(('end',), tag=nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SecureBoxException('Archive is truncated')
+    return data
+
+
+def read_archive(key, stream):
+    """Yield the records of the archive in the file-like stream."""
+    magic = _read_exactly(stream, len(MAGIC))
+    if magic != MAGIC:
+        if magic[:-1] == MAGIC[:-1]:
+            raise SecureBoxException('Unsupported SecureBox archive version {!r}'.format(magic[-1:]))
+        raise SecureBoxException('Not a SecureBox archive')
+
+    state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+    try:
+        nacl.bindings.crypto_secretstream_xchacha20poly1305_init_pull(state, _read_exactly(stream, HEADER_SIZE), key)
+        while True:
+            length, = LENGTH.unpack(_read_exactly(stream, LENGTH.size))
+            data, tag = nacl.bindings.crypto_secretstream_xchacha20poly1305_pull(
+                state, _read_exactly(stream, length),
+            )
+            if tag == nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL:
+                return
+            yield decode_record(data)
+    except nacl.exceptions.CryptoError as e:
+        raise SecureBoxException('Internal CryptoError') from e
+
+
+class _Importer:
+    def __init__(self, user_id, batch_size):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.values = []
+        self.last_obj = None
+        self.blob = None
+        self.chunks = []
+        self.chunks_size = 0
+        self.count = 0
+
+    def add_box(self, user_key, public_key, private_key, opslimit, memlimit):
+        from .models import SecureObject, SecureObjectLink, UserSecureBox
+
+        userbox = UserSecureBox.objects.filter(user_id=self.user_id).first()
+        if userbox is not None and bytes(userbox._user_key) == user_key:
+            return
+        if userbox is None:
+            userbox = UserSecureBox(user_id=self.user_id)
+        else:
+            # Values stored under the replaced user key can't be read anymore
+            links = SecureObjectLink.objects.filter(user_id=self.user_id)
+            obj_ids = list(links.values_list('obj_id', flat=True))
+            links.delete()
+            SecureObject.clean_orphaned(obj_ids)
+            cache.invalidate_user(self.user_id)
+
+        userbox._user_key = user_key
+        userbox.public_key = public_key
+        userbox._private_key = private_key
+        userbox.kdf_params = {'opslimit': opslimit, 'memlimit': memlimit}
+        userbox.save()
+
+    def add_value(self, name, object_key, sealed, expires_at, data):
+        if expires_at is not None:
+            expires_at = datetime.fromtimestamp(expires_at, timezone.utc)
+        self.flush_blob()
+        self.values.append((name, object_key, sealed, expires_at, data))
+        if len(self.values) >= self.batch_size:
+            self.flush_values()
+
+    def flush_values(self):
+        from .models import SecureObject, SecureObjectLink
+
+        if not self.values:
+            return
+        names = [name for name, _, _, _, _ in self.values]
+        objs = [SecureObject(data=data) for _, _, _, _, data in self.values]
+
+        links = SecureObjectLink.objects.filter(user_id=self.user_id, name__in=names)
+        obj_ids = list(links.values_list('obj_id', flat=True))
+        links.delete()
+        SecureObject.clean_orphaned(obj_ids)
+
+        if connection.features.can_return_rows_from_bulk_insert:
+            SecureObject.objects.bulk_create(objs)
+        else:
+            for obj in objs:
+                obj.save()
+        SecureObjectLink.objects.bulk_create([
+            SecureObjectLink(
+                user_id=self.user_id, obj=obj, name=name, object_key=object_key, sealed=sealed, expires_at=expires_at,
+            )
+            for obj, (name, object_key, sealed, expires_at, _) in zip(objs, self.values)
+        ])
+        cache.invalidate(self.user_id, names)
+
+        self.last_obj = objs[-1]
+        self.count += len(objs)
+        self.values = []
+
+    def add_blob(self, header):
+        from .models import SecureBlob
+
+        self.flush_blob()
+        self.flush_values()  # The blob belongs to the last value, which needs its primary key
+        if self.last_obj is None:
+            raise SecureBoxException('Blob without a value')
+        self.blob = SecureBlob.objects.create(obj=self.last_obj, header=header)
+        self.blob_index = 0
+
+    def add_chunk(self, data):
+        from .models import SecureBlobChunk
+
+        if self.blob is None:
+            raise SecureBoxException('Blob chunk without a blob')
+        self.chunks.append(SecureBlobChunk(blob=self.blob, index=self.blob_index, data=data))
+        self.blob_index += 1
+        self.chunks_size += len(data)
+        if self.chunks_size >= BLOB_BATCH_BYTES:
+            self.flush_chunks()
+
+    def flush_chunks(self):
+        from .models import SecureBlobChunk
+
+        SecureBlobChunk.objects.bulk_create(self.chunks)
+        self.chunks = []
+        self.chunks_size = 0
+
+    def flush_blob(self):
+        if self.blob is not None:
+            self.flush_chunks()
+            self.blob = None
+
+    def finish(self):
+        self.flush_blob()
+        self.flush_values()
+
+
+def import_user(user_id, key, stream, batch_size=1000):
+    """Write the archive in the file-like stream back for the user, returns the number of values.
+
+    Values replace existing values of the same name. If the archive comes
+    from a box with a different user key, that box replaces the user's box,
+    and all of the user's values are deleted first. The import runs in one
+    transaction, so a corrupt or truncated archive changes nothing."""
+    importer = _Importer(user_id, batch_size)
+    records = read_archive(key, stream)
+
+    with transaction.atomic():
+        record = next(records, None)
+        if record is None:  # Exported from a user without a box
+            return 0
+        if record[0] != 'box':
+            raise SecureBoxException('Archive does not start with a box')
+        importer.add_box(*record[1:])
+
+        for record in records:
+            if record[0] == 'value':
+                importer.add_value(*record[1:])
+            elif record[0] == 'blob':
+                importer.add_blob(*record[1:])
+            elif record[0] == 'chunk':
+                importer.add_chunk(*record[1:])
+            else:
+                raise SecureBoxException('Unknown archive record {!r}'.format(record[0]))
+        importer.finish()
+    return importer.count
@@ -0,0 +1,149 @@
+"""Large values, encrypted in chunks with libsodium's secretstream.
+
+A blob is written chunk by chunk into SecureBlobChunk rows and read back the
+same way, so memory use depends on the chunk size, not the blob size. The
+stream key is stored as a regular permanent value (a BlobReference) under the
+blob's name.
+"""
+
+from collections import namedtuple
+
+import nacl.bindings
+import nacl.exceptions
+from django.http import StreamingHttpResponse
+
+from django_securebox.utils import SecureBoxException
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+BlobReference = namedtuple('BlobReference', ['pk', 'key'])
+
+
+class BlobWriter:
+    """Write-only file-like object, the blob is stored under its name on close()."""
+
+    def __init__(self, securebox, name, chunk_size=DEFAULT_CHUNK_SIZE):
+        from .models import SecureBlob
+
+        self.securebox = securebox
+        self.name = name
+        self.chunk_size = chunk_size
+        self.key = nacl.bindings.crypto_secretstream_xchacha20poly1305_keygen()
+        self.state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+        self.blob = SecureBlob.objects.create(
+            header=nacl.bindings.crypto_secretstream_xchacha20poly1305_init_push(self.state, self.key),
+        )
+        self.index = 0
+        self.buffer = bytearray()
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed blob')
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._push(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def _push(self, data, tag=nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE):
+        from .models import SecureBlobChunk
+
+        SecureBlobChunk.objects.create(
+            blob=self.blob,
+            index=self.index,
+            data=nacl.bindings.crypto_secretstream_xchacha20poly1305_push(self.state, bytes(data), tag=tag),
+        )
+        self.index += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._push(self.buffer, tag=nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL)
+            self.buffer = bytearray()
+            self.securebox._store_blob_reference(self.name, BlobReference(self.blob.pk, self.key))
+        except BaseException:
+            self.blob.delete()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.blob.delete()
+
+
+class BlobReader:
+    """Read-only file-like object, also iterable over the decrypted chunks."""
+
+    def __init__(self, blob, key, prefetch=4):
+        self.blob = blob
+        self.prefetch = prefetch
+        self.state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+        nacl.bindings.crypto_secretstream_xchacha20poly1305_init_pull(self.state, bytes(blob.header), key)
+        self.chunks = self._chunks()
+        self.buffer = b''
+
+    def _chunks(self):
+        from .models import SecureBlobChunk
+
+        index = 0
+        while True:
+            # Only a few chunks are loaded at a time
+            batch = list(
+                SecureBlobChunk.objects.filter(
+                    blob=self.blob, index__gte=index, index__lt=index + self.prefetch,
+                ).order_by('index').values_list('data', flat=True)
+            )
+            for data in batch:
+                try:
+                    message, tag = nacl.bindings.crypto_secretstream_xchacha20poly1305_pull(self.state, bytes(data))
+                except nacl.exceptions.CryptoError as e:
+                    raise SecureBoxException('Internal CryptoError') from e
+                yield message
+                if tag == nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL:
+                    return
+            if len(batch) < self.prefetch:
+                raise SecureBoxException('Blob is truncated')
+            index += self.prefetch
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def __iter__(self):
+        if self.buffer:
+            yield self.read(len(self.buffer))
+        yield from self.chunks
+
+    def close(self):
+        self.chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def blob_response(securebox, name, content_type='application/octet-stream', **kwargs):
+    return StreamingHttpResponse(securebox.open_reader(name), content_type=content_type, **kwargs)
@@ -0,0 +1,118 @@
+"""Cross-request cache of permanent values, still encrypted.
+
+With ``SECUREBOX_CACHE`` set to a cache alias, the rows of a
+SecureObjectLink and its SecureObject are cached as they are stored in the
+database, so only ciphertext ever reaches the cache. Entries are dropped
+when a link is written or deleted, and for every link of an object when
+the object is written, as shared objects are cached per user. Resetting a
+user key bumps a per-user version, which orphans all of that user's
+entries at once.
+"""
+
+import random
+from contextlib import suppress
+
+import nacl.hash
+from django.conf import settings
+from django.core.cache import caches
+
+VERSION_KEY = 'django_securebox:version:{}'
+# The row format is part of the key, so entries of older versions are never read
+LINK_KEY = 'django_securebox:link2:{}:{}:{}'
+
+
+def get_cache():
+    alias = getattr(settings, 'SECUREBOX_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _version(cache, user_id):
+    version_key = VERSION_KEY.format(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        # Start at a random version, so that an evicted version never brings back stale entries
+        cache.add(version_key, random.getrandbits(48), timeout=None)
+        version = cache.get(version_key)
+    return version
+
+
+def _link_keys(cache, user_id, names):
+    version = _version(cache, user_id)
+    return {
+        LINK_KEY.format(
+            user_id, version, nacl.hash.blake2b(name.encode('utf-8'), digest_size=16).decode('us-ascii')
+        ): name
+        for name in names
+    }
+
+
+def get_links(user_id, names):
+    """Cached links by name, with their objects attached."""
+    cache = get_cache()
+    if cache is None or not names:
+        return {}
+
+    from .models import SecureObject, SecureObjectLink
+
+    link_keys = _link_keys(cache, user_id, names)
+    link_objs = {}
+    for link_key, row in cache.get_many(list(link_keys)).items():
+        link_id, obj_id, object_key, sealed, expires_at, data = row
+        link_obj = SecureObjectLink.from_db(
+            None, ['id', 'user_id', 'obj_id', 'name', 'object_key', 'sealed', 'expires_at'],
+            [link_id, user_id, obj_id, link_keys[link_key], object_key, sealed, expires_at],
+        )
+        link_obj.obj = SecureObject.from_db(None, ['id', 'data'], [obj_id, data])
+        link_objs[link_obj.name] = link_obj
+    return link_objs
+
+
+def set_links(user_id, link_objs):
+    cache = get_cache()
+    if cache is None or not link_objs:
+        return
+
+    names = [link_obj.name for link_obj in link_objs]
+    link_keys = {name: link_key for link_key, name in _link_keys(cache, user_id, names).items()}
+    cache.set_many({
+        link_keys[link_obj.name]: (
+            link_obj.pk, link_obj.obj_id, bytes(link_obj.object_key), link_obj.sealed, link_obj.expires_at,
+            bytes(link_obj.obj.data),
+        )
+        for link_obj in link_objs
+    })
+
+
+def invalidate(user_id, names):
+    cache = get_cache()
+    if cache is None or not names:
+        return
+    cache.delete_many(list(_link_keys(cache, user_id, names)))
+
+
+def invalidate_objects(obj_ids, batch_size=1000):
+    """Drop the entries of all links to the objects, of every user they are shared with."""
+    cache = get_cache()
+    if cache is None:
+        return
+
+    from .models import SecureObjectLink
+
+    obj_ids = list(obj_ids)
+    for start in range(0, len(obj_ids), batch_size):
+        names = {}
+        links = SecureObjectLink.objects.filter(obj_id__in=obj_ids[start:start + batch_size])
+        for user_id, name in links.values_list('user_id', 'name'):
+            names.setdefault(user_id, []).append(name)
+        for user_id, user_names in names.items():
+            invalidate(user_id, user_names)
+
+
+def invalidate_user(user_id):
+    cache = get_cache()
+    if cache is None:
+        return
+    with suppress(ValueError):  # No version yet, the next read starts a fresh one
+        cache.incr(VERSION_KEY.format(user_id))
@@ -0,0 +1,30 @@
+"""Secret key encryption on top of nacl.bindings.
+
+Reads and writes the same format as nacl.secret.SecretBox, the nonce followed
+by the authenticated ciphertext, but without creating a SecretBox and an
+EncryptedMessage per operation. Ciphertexts can be any bytes-like object;
+memoryviews as returned by database drivers are sliced, not copied.
+"""
+
+import nacl.bindings
+import nacl.utils
+
+KEY_SIZE = nacl.bindings.crypto_secretbox_KEYBYTES
+NONCE_SIZE = nacl.bindings.crypto_secretbox_NONCEBYTES
+
+
+def generate_key():
+    return nacl.utils.random(KEY_SIZE)
+
+
+def encrypt(key, plaintext):
+    nonce = nacl.utils.random(NONCE_SIZE)
+    return nonce + nacl.bindings.crypto_secretbox(plaintext, nonce, key)
+
+
+def decrypt(key, data):
+    """Plaintext of data, raises nacl.exceptions.CryptoError if it can't be decrypted."""
+    data = memoryview(data)
+    if len(data) < NONCE_SIZE:
+        raise nacl.exceptions.CryptoError('Ciphertext is too short')
+    return nacl.bindings.crypto_secretbox_open(data[NONCE_SIZE:], data[:NONCE_SIZE].tobytes(), key)
@@ -0,0 +1,165 @@
+"""Password based key derivation, optionally offloaded to a bounded worker pool.
+
+The cost parameters come from the ``SECUREBOX_KDF`` setting, e.g.::
+
+    SECUREBOX_KDF = {
+        'opslimit': nacl.pwhash.OPSLIMIT_MODERATE,
+        'memlimit': nacl.pwhash.MEMLIMIT_MODERATE,
+    }
+
+The pool is configured with the ``SECUREBOX_KDF_POOL`` setting, e.g.::
+
+    SECUREBOX_KDF_POOL = {
+        'executor': 'thread',  # or 'process'
+        'max_workers': 2,      # concurrent derivations (each needs memlimit bytes of RAM)
+        'max_queue': 8,        # derivations allowed to wait for a worker
+        'timeout': 5,          # seconds to wait for a queue slot, None waits forever
+    }
+
+Without the setting derivations run inline in the calling thread.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import nacl.pwhash
+import nacl.secret
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from nacl.pwhash import argon2id as chosen_kdf
+
+from django_securebox import metrics
+from django_securebox.utils import SecureBoxBusy
+
+DEFAULT_PARAMS = {
+    'opslimit': nacl.pwhash.OPSLIMIT_SENSITIVE,
+    'memlimit': nacl.pwhash.MEMLIMIT_MODERATE,
+}
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def get_params():
+    params = dict(DEFAULT_PARAMS)
+    params.update(getattr(settings, 'SECUREBOX_KDF', {}))
+    return params
+
+
+def derive_key(password, salt, opslimit=DEFAULT_PARAMS['opslimit'], memlimit=DEFAULT_PARAMS['memlimit']):
+    return chosen_kdf.kdf(
+        nacl.secret.SecretBox.KEY_SIZE,
+        password,
+        salt,
+        opslimit=opslimit,
+        memlimit=memlimit,
+    )
+
+
+class KDFPool:
+    def __init__(self, executor='thread', max_workers=1, max_queue=0, timeout=None):
+        self.executor = EXECUTORS[executor](max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.timeout = timeout
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise SecureBoxBusy('KDF worker pool is busy')
+
+    def submit(self, *args, **kwargs):
+        self.acquire()
+        return self._submit(*args, **kwargs)
+
+    async def asubmit(self, *args, **kwargs):
+        # Waiting for a slot blocks, so keep it off the event loop
+        waiter = _SlotWaiter(self)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, waiter.acquire)
+        except asyncio.CancelledError:
+            waiter.cancel()
+            raise
+        return self._submit(*args, **kwargs)
+
+    def _submit(self, *args, **kwargs):
+        try:
+            future = self.executor.submit(derive_key, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class _SlotWaiter:
+    """Acquires a slot in a worker thread for asubmit(), and gives it back if the awaiting task was cancelled.
+
+    The thread can't be interrupted, so it may get the slot after the
+    cancellation; whichever side comes second releases it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.acquired = False
+        self.cancelled = False
+
+    def acquire(self):
+        self.pool.acquire()
+        with self.lock:
+            if self.cancelled:
+                self.pool.slots.release()
+            else:
+                self.acquired = True
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.acquired:
+                self.pool.slots.release()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    config = getattr(settings, 'SECUREBOX_KDF_POOL', None)
+    if config is None:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = KDFPool(**config)
+        return _pool
+
+
+@receiver(setting_changed)
+def reset_pool(setting, **kwargs):
+    global _pool
+    if setting == 'SECUREBOX_KDF_POOL':
+        with _pool_lock:
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = None
+
+
+def derive(*args, **kwargs):
+    pool = get_pool()
+    with metrics.measure('kdf'):
+        if pool is None:
+            return derive_key(*args, **kwargs)
+        return pool.submit(*args, **kwargs).result()
+
+
+async def aderive(*args, **kwargs):
+    pool = get_pool()
+    with metrics.measure('kdf'):
+        if pool is None:
+            return await asyncio.get_event_loop().run_in_executor(None, lambda: derive_key(*args, **kwargs))
+        return await asyncio.wrap_future(await pool.asubmit(*args, **kwargs))
@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_securebox.models import SecureBlob, SecureObject
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete SecureObjects without links, in batches of primary key ranges, '
+        'and SecureBlobs that were never attached to a value.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of objects to check per batch.')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches.')
+        parser.add_argument('--blob-age', type=float, default=24 * 60 * 60,
+                            help='Seconds after which an unattached blob is considered abandoned; '
+                                 'younger ones may still be written.')
+
+    def handle(self, chunk_size, sleep, blob_age, **options):
+        last_pk = 0
+        deleted = 0
+
+        while True:
+            pks = list(
+                SecureObject.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not pks:
+                break
+
+            count, _ = SecureObject.objects.filter(pk__gt=last_pk, pk__lte=pks[-1], links=None).delete()
+            deleted += count
+            last_pk = pks[-1]
+
+            if sleep:
+                time.sleep(sleep)
+
+        created_before = timezone.now() - timedelta(seconds=blob_age)
+        while True:
+            pks = list(
+                SecureBlob.objects.filter(
+                    obj=None, created_at__lt=created_before,
+                ).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not pks:
+                break
+
+            count, _ = SecureBlob.objects.filter(pk__in=pks, obj=None).delete()
+            deleted += count
+
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write('Deleted {} rows'.format(deleted))
@@ -0,0 +1,43 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from django_securebox.archive import export_user, load_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Export users' stored values into encrypted archives, one <username>.sbx file per user. "
+        "Values are exported without decrypting them, no passwords are needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('usernames', nargs='*',
+                            help='Users to export, all users with a SecureBox if none are given.')
+        parser.add_argument('--key-file', required=True,
+                            help='File holding the base64 encoded 32 byte archive key.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of rows to fetch per query.')
+
+    def handle(self, directory, usernames, key_file, chunk_size, **options):
+        try:
+            key = load_key(key_file)
+        except (OSError, ValueError) as e:
+            raise CommandError('Invalid key file: {}'.format(e))
+
+        User = get_user_model()
+        users = User.objects.filter(secure_box__isnull=False)
+        if usernames:
+            users = users.filter(**{User.USERNAME_FIELD + '__in': usernames})
+
+        os.makedirs(directory, exist_ok=True)
+        count = 0
+        for user in users.iterator():
+            path = os.path.join(directory, '{}.sbx'.format(user.get_username()))
+            with open(path, 'wb') as f:
+                for data in export_user(user.pk, key, chunk_size=chunk_size):
+                    f.write(data)
+            count += 1
+        self.stdout.write('Exported {} users'.format(count))
@@ -0,0 +1,42 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from django_securebox.archive import import_user, load_key
+from django_securebox.utils import SecureBoxException
+
+
+class Command(BaseCommand):
+    help = (
+        "Import archives written by securebox_export. Each <username>.sbx file is imported "
+        "for the user of that name, replacing values of the same name."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--key-file', required=True,
+                            help='File holding the base64 encoded 32 byte archive key.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of values to write per bulk insert.')
+
+    def handle(self, files, key_file, batch_size, **options):
+        try:
+            key = load_key(key_file)
+        except (OSError, ValueError) as e:
+            raise CommandError('Invalid key file: {}'.format(e))
+
+        User = get_user_model()
+        for path in files:
+            username, _ = os.path.splitext(os.path.basename(path))
+            try:
+                user = User.objects.get(**{User.USERNAME_FIELD: username})
+            except User.DoesNotExist:
+                raise CommandError('No user {!r} for {}'.format(username, path))
+
+            with open(path, 'rb') as f:
+                try:
+                    count = import_user(user.pk, key, f, batch_size=batch_size)
+                except SecureBoxException as e:
+                    raise CommandError('Could not import {}: {}'.format(path, e))
+            self.stdout.write('Imported {} values for {}'.format(count, username))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_securebox.models import SecureObject, SecureObjectLink
+
+
+class Command(BaseCommand):
+    help = 'Delete expired values, in batches, and the SecureObjects only they linked to.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of values to delete per batch.')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches.')
+
+    def handle(self, batch_size, sleep, **options):
+        now = timezone.now()
+        deleted = 0
+
+        while True:
+            links = list(
+                SecureObjectLink.objects.filter(expires_at__lte=now).values_list('pk', 'obj_id')[:batch_size]
+            )
+            if not links:
+                break
+
+            SecureObjectLink.objects.filter(pk__in=[pk for pk, _ in links]).delete()
+            SecureObject.clean_orphaned([obj_id for _, obj_id in links])
+            deleted += len(links)
+
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write('Deleted {} expired values'.format(deleted))
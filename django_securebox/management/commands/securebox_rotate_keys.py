@@ -0,0 +1,45 @@
+import getpass
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from django_securebox.models import UserSecureBox
+from django_securebox.rotation import rotate_user
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt a user's stored values with fresh object keys. "
+        "Interrupted runs continue where they stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--password-stdin', action='store_true',
+                            help='Read the password from the first line of stdin instead of prompting.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of values to rewrite per transaction.')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Number of worker processes for the encryption, 0 to encrypt in this process.')
+        parser.add_argument('--reencode', action='store_true',
+                            help='Also re-serialize values with the current serializer and compression settings.')
+
+    def handle(self, username, password_stdin, chunk_size, workers, reencode, **options):
+        User = get_user_model()
+        try:
+            userbox = UserSecureBox.objects.select_related('user').get(**{'user__' + User.USERNAME_FIELD: username})
+        except UserSecureBox.DoesNotExist:
+            raise CommandError('No SecureBox for user {!r}'.format(username))
+
+        if password_stdin:
+            password = sys.stdin.readline().rstrip('\n')
+        else:
+            password = getpass.getpass('Password for {}: '.format(username))
+
+        if not userbox.user.check_password(password):
+            raise CommandError('Wrong password')
+
+        userbox.login(password)
+        count = rotate_user(userbox, userbox.user_key, chunk_size=chunk_size, workers=workers, reencode=reencode)
+        self.stdout.write('Rotated {} values'.format(count))
@@ -1,7 +1,14 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
 from django.utils.deprecation import MiddlewareMixin
 from django.utils.functional import SimpleLazyObject
 
-from django_securebox.utils import SecureBox
+from django_securebox import metrics
+from django_securebox.utils import SecureBox, SecureBoxBusy
+
+# Seconds a client is asked to wait after SecureBoxBusy
+BUSY_RETRY_AFTER = 1
 
 
 def get_securebox(request):
@@ -19,8 +26,41 @@ class SecureBoxMiddleware(MiddlewareMixin):
         ) % ("_CLASSES" if settings.MIDDLEWARE is None else "")
     
         request.securebox = SimpleLazyObject(lambda: get_securebox(request))
+        if metrics.get_config() is not None:
+            request._securebox_metrics_token = metrics.start()
 
     def process_response(self, request, response):
         if hasattr(request, '_cached_securebox'):
             request._cached_securebox.process_response(response)
+        self._finish_metrics(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, SecureBoxBusy):
+            response = HttpResponse('Too many concurrent logins, please try again.', status=503,
+                                    content_type='text/plain')
+            response['Retry-After'] = str(BUSY_RETRY_AFTER)
+            return response
+        return None
+
+    def _finish_metrics(self, request, response):
+        if hasattr(request, '_securebox_metrics_token'):
+            metrics.finish(request._securebox_metrics_token, request, response)
+
+    async def __acall__(self, request):
+        # process_request() does no I/O, so call it directly instead of
+        # hopping to a thread like MiddlewareMixin does
+        self.process_request(request)
+        response = await self.get_response(request)
+
+        securebox = getattr(request, '_cached_securebox', None)
+        if securebox is not None:
+            # Writing the transient vault and any SECUREBOX_TRANSIENT_CACHE
+            # access can hit the database or the network
+            if securebox.process_response_needs_io():
+                await sync_to_async(securebox.process_response)(response)
+            else:
+                securebox.process_response(response)
+        # Metrics are reset in this context, where they were started
+        self._finish_metrics(request, response)
         return response
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_securebox', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersecurebox',
+            name='kdf_memlimit',
+            field=models.BigIntegerField(default=268435456),
+        ),
+        migrations.AddField(
+            model_name='usersecurebox',
+            name='kdf_opslimit',
+            field=models.IntegerField(default=4),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_securebox', '0002_usersecurebox_kdf_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersecurebox',
+            name='rotation_checkpoint',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_securebox', '0003_usersecurebox_rotation_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecureBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('header', models.BinaryField()),
+                ('obj', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='blobs', to='django_securebox.SecureObject')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SecureBlobChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='django_securebox.SecureBlob')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='secureblobchunk',
+            unique_together=set([('blob', 'index')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_securebox', '0004_secureblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersecurebox',
+            name='_private_key',
+            field=models.BinaryField(db_column='private_key', default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='usersecurebox',
+            name='public_key',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='secureobjectlink',
+            name='sealed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
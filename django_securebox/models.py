@@ -1,15 +1,16 @@
-import pickle
 from contextlib import suppress
 
 import nacl.encoding
 import nacl.hash
 import nacl.public
-import nacl.pwhash
 import nacl.secret
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import connection, models, transaction
+from django.utils import timezone
 from nacl.pwhash import argon2id as chosen_kdf
 
+from django_securebox import cache, crypto, kdf, metrics, serializers
 from django_securebox.utils import SecureBoxException
 
 
@@ -17,32 +18,41 @@ class SecureObject(models.Model):
     data = models.BinaryField()
 
     @classmethod
-    def clean_orphaned(cls):
-        cls.objects.filter(links=None).delete()
+    def clean_orphaned(cls, ids=None, batch_size=1000):
+        """Delete objects that have no links left.
 
-    def get_data(self, object_key):
-        try:
-            data = nacl.secret.SecretBox(
-                object_key
-            ).decrypt(
-                bytes(self.data)
-            )
+        Only the objects with the given ids are checked. Without ids the whole
+        table is scanned, see the securebox_clean_orphans command for a
+        batched version of that."""
+        if ids is None:
+            cls.objects.filter(links=None).delete()
+            return
 
-            return pickle.loads(data)
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            cls.objects.filter(pk__in=ids[start:start + batch_size], links=None).delete()
+
+    def get_plaintext(self, object_key):
+        """The serialized value, see get_data()."""
+        try:
+            with metrics.measure('decrypt'):
+                return crypto.decrypt(object_key, self.data)
 
         except nacl.exceptions.CryptoError as e:
             self.delete()
             raise SecureBoxException('Internal CryptoError') from e
 
-    def set_data(self, object_key, value):
-        data = pickle.dumps(value)
-        self.data = nacl.secret.SecretBox(
-            object_key
-        ).encrypt(
-            data
-        )
-        self.save()
-        self.refresh_from_db()
+    def get_data(self, object_key):
+        return serializers.loads(self.get_plaintext(object_key))
+
+    def set_data(self, object_key, value, commit=True):
+        """Encrypt value, returns it serialized."""
+        data = serializers.dumps(value)
+        with metrics.measure('encrypt'):
+            self.data = crypto.encrypt(object_key, data)
+        if commit:
+            self.save(update_fields=None if self._state.adding else ['data'])
+        return data
 
 
 class SecureObjectLink(models.Model):
@@ -58,50 +68,163 @@ class SecureObjectLink(models.Model):
     )
     name = models.CharField(max_length=255)
     object_key = models.BinaryField()
+    # object_key is sealed to the user's public key until the share is accepted
+    sealed = models.BooleanField(default=False)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     class Meta:
         unique_together = (
             ('user', 'name'),
         )
 
-    def get_data(self, key):
+    def get_plaintext(self, key):
+        """The serialized value, see get_data()."""
         try:
-            object_key = nacl.secret.SecretBox(
-                key
-            ).decrypt(
-                bytes(self.object_key),
-            )
+            with metrics.measure('decrypt'):
+                object_key = crypto.decrypt(key, self.object_key)
 
-            return self.obj.get_data(object_key)
+            return self.obj.get_plaintext(object_key)
 
         except (SecureBoxException, nacl.exceptions.CryptoError) as e:
             self.delete()
-            SecureObject.clean_orphaned()
+            cache.invalidate(self.user_id, [self.name])
+            SecureObject.clean_orphaned([self.obj_id])
             raise SecureBoxException('Internal CryptoError') from e
 
-    def set_data(self, key, value):
+    def get_data(self, key):
+        """The decrypted value.
+
+        Rows that fail to decrypt are deleted and raise SecureBoxException.
+        Values in a format that can't be read here raise SecureBoxFormatError
+        and are kept."""
+        return serializers.loads(self.get_plaintext(key))
+
+    def accept(self, key, private_key):
+        """Rewrap the object key of a shared link from the user's key pair to key."""
+        try:
+            object_key = nacl.public.SealedBox(private_key).decrypt(bytes(self.object_key))
+        except nacl.exceptions.CryptoError as e:
+            self.delete()
+            cache.invalidate(self.user_id, [self.name])
+            SecureObject.clean_orphaned([self.obj_id])
+            raise SecureBoxException('Internal CryptoError') from e
+
+        self.object_key = crypto.encrypt(key, object_key)
+        self.sealed = False
+        self.save(update_fields=['object_key', 'sealed'])
+        cache.invalidate(self.user_id, [self.name])
+
+    def is_expired(self, now=None):
+        return self.expires_at is not None and self.expires_at <= (now or timezone.now())
+
+    def set_data(self, key, value, commit=True, expires_at=None):
+        """Encrypt value for this link, returns it serialized."""
         object_key = None
         if self.object_key:
             with suppress(nacl.exceptions.CryptoError):  # Ignore error, set a new object_key
-                object_key = nacl.secret.SecretBox(
-                    key
-                ).decrypt(
-                    bytes(self.object_key),
-                )
+                object_key = crypto.decrypt(key, self.object_key)
 
+        update_fields = []
         if not object_key:
-            object_key = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+            object_key = crypto.generate_key()
+            self.object_key = crypto.encrypt(key, object_key)
+            update_fields.append('object_key')
 
-            self.object_key = nacl.secret.SecretBox(
-                key
-            ).encrypt(
-                object_key
-            )
+        if expires_at != self.expires_at:
+            self.expires_at = expires_at
+            update_fields.append('expires_at')
+
+        if not commit:
+            return self.obj.set_data(object_key, value, commit=False)
+
+        with transaction.atomic():
+            data = self.obj.set_data(object_key, value)
+            self.obj = self.obj
+            if self._state.adding:
+                self.save()
+            elif update_fields:
+                self.save(update_fields=update_fields)
+            if self._replaces_blob(value):
+                SecureBlob.objects.filter(obj_id=self.obj_id).delete()
+                self.has_blobs = False
+        cache.invalidate_objects([self.obj_id])
+        return data
+
+    def _replaces_blob(self, value):
+        """Whether value replaces a blob, needs links looked up with a has_blobs annotation."""
+        from .blobs import BlobReference
+
+        return getattr(self, 'has_blobs', False) and not isinstance(value, BlobReference)
+
+    @classmethod
+    def set_data_many(cls, key, links_values, expires_at=None):
+        """set_data() for (link, value) pairs, with bulk queries for all rows.
+
+        Returns the serialized values, in order."""
+        new_links, changed_links, serialized = [], [], []
+        for link_obj, value in links_values:
+            object_key, link_expires_at = link_obj.object_key, link_obj.expires_at
+            serialized.append(link_obj.set_data(key, value, commit=False, expires_at=expires_at))
+            if link_obj._state.adding:
+                new_links.append(link_obj)
+            elif link_obj.object_key is not object_key or link_obj.expires_at != link_expires_at:
+                changed_links.append(link_obj)
+
+        new_objs = [link_obj.obj for link_obj in new_links]
+        objs = [link_obj.obj for link_obj, _ in links_values if not link_obj.obj._state.adding]
+        replaced_blobs = [link_obj.obj_id for link_obj, value in links_values if link_obj._replaces_blob(value)]
+
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                SecureObject.objects.bulk_create(new_objs)
+            else:
+                for obj in new_objs:
+                    obj.save()
+            if objs:
+                SecureObject.objects.bulk_update(objs, ['data'])
+
+            for link_obj in new_links:
+                link_obj.obj = link_obj.obj
+            cls.objects.bulk_create(new_links)
+            if changed_links:
+                cls.objects.bulk_update(changed_links, ['object_key', 'expires_at'])
+            if replaced_blobs:
+                SecureBlob.objects.filter(obj_id__in=replaced_blobs).delete()
+
+        cache.invalidate_objects(link_obj.obj_id for link_obj, _ in links_values)
+        return serialized
 
-        self.obj.set_data(object_key, value)
-        self.obj = self.obj
-        self.save()
-        self.refresh_from_db()
+
+class SecureBlob(models.Model):
+    """Large value encrypted as a secretstream, in SecureBlobChunk rows.
+
+    obj is the SecureObject holding the blob's reference, deleting the value
+    or overwriting it with a plain value deletes the blob. It is unset until
+    the blob is completely written; securebox_clean_orphans deletes blobs
+    that stay unset, by created_at."""
+    obj = models.ForeignKey(
+        'SecureObject',
+        on_delete=models.CASCADE,
+        related_name='blobs',
+        null=True,
+    )
+    header = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class SecureBlobChunk(models.Model):
+    blob = models.ForeignKey(
+        'SecureBlob',
+        on_delete=models.CASCADE,
+        related_name='chunks',
+    )
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = (
+            ('blob', 'index'),
+        )
 
 
 class UserSecureBox(models.Model):
@@ -111,14 +234,27 @@ class UserSecureBox(models.Model):
         related_name='secure_box',
     )
     _user_key = models.BinaryField(db_column='user_key')
+    public_key = models.BinaryField()
+    _private_key = models.BinaryField(db_column='private_key')
+    kdf_opslimit = models.IntegerField(default=kdf.DEFAULT_PARAMS['opslimit'])
+    kdf_memlimit = models.BigIntegerField(default=kdf.DEFAULT_PARAMS['memlimit'])
+    # Last SecureObjectLink rotated by an unfinished rotation.rotate_user()
+    rotation_checkpoint = models.IntegerField(null=True, blank=True)
+
+    @property
+    def kdf_params(self):
+        return {'opslimit': self.kdf_opslimit, 'memlimit': self.kdf_memlimit}
+
+    @kdf_params.setter
+    def kdf_params(self, value):
+        self.kdf_opslimit = value['opslimit']
+        self.kdf_memlimit = value['memlimit']
 
     @property
     def user_key(self):
         if hasattr(self, '_user_key_wrapkey'):
             try:
-                return nacl.secret.SecretBox(self._user_key_wrapkey).decrypt(
-                    bytes(self._user_key)
-                )
+                return crypto.decrypt(self._user_key_wrapkey, self._user_key)
             except nacl.exceptions.CryptoError:
                 self.reset_user_key()
                 return self.user_key
@@ -128,15 +264,24 @@ class UserSecureBox(models.Model):
     @user_key.setter
     def user_key(self, value):
         if hasattr(self, '_user_key_wrapkey'):
-            self._user_key = nacl.secret.SecretBox(self._user_key_wrapkey).encrypt(
-                value
-            )
+            self._user_key = crypto.encrypt(self._user_key_wrapkey, value)
         else:
             raise SecureBoxException('Need to login() for user_key operations')
 
     def generate_keys(self):
         if not self._user_key:
             self.reset_user_key()
+        elif not self.public_key:
+            self._set_keypair()
+            self.save(update_fields=['public_key', '_private_key'])
+
+    def _set_keypair(self):
+        private_key = nacl.public.PrivateKey.generate()
+        self.public_key = bytes(private_key.public_key)
+        self._private_key = crypto.encrypt(self.user_key, bytes(private_key))
+
+    def get_private_key(self, user_key):
+        return nacl.public.PrivateKey(crypto.decrypt(user_key, self._private_key))
 
     def reset_user_key(self):
         # Delete user_key, delete private_key
@@ -148,22 +293,66 @@ class UserSecureBox(models.Model):
         self._user_key = b''
         self.save()
 
-        self.user.secure_objects.filter().delete()
-        SecureObject.clean_orphaned()
+        links = self.user.secure_objects.filter()
+        obj_ids = list(links.values_list('obj_id', flat=True))
+        links.delete()
+        cache.invalidate_user(self.user_id)
+        SecureObject.clean_orphaned(obj_ids)
 
         self.user_key = nacl.utils.random(32)
+        self._set_keypair()
         self.save()
 
+    def get_kdf_salt(self):
+        return nacl.hash.blake2b(
+            data=self.user.password.encode('US-ASCII'),
+            digest_size=chosen_kdf.SALTBYTES,
+            encoder=nacl.encoding.RawEncoder)
+
     def login(self, pwd):
-        self._user_key_wrapkey = chosen_kdf.kdf(
-            nacl.secret.SecretBox.KEY_SIZE,
-            pwd.encode('UTF-8'),
-            nacl.hash.blake2b(
-                data=self.user.password.encode('US-ASCII'),
-                digest_size=chosen_kdf.SALTBYTES,
-                encoder=nacl.encoding.RawEncoder),
-            opslimit=nacl.pwhash.OPSLIMIT_SENSITIVE,
-            memlimit=nacl.pwhash.MEMLIMIT_MODERATE,
-        )
+        pwd = pwd.encode('UTF-8')
+        salt = self.get_kdf_salt()
+        params = kdf.get_params()
+
+        if self._user_key and self.kdf_params != params:
+            # Wrapped with outdated parameters, unwrap and rewrap transparently
+            self._user_key_wrapkey = kdf.derive(pwd, salt, **self.kdf_params)
+            self._rewrap_user_key(kdf.derive(pwd, salt, **params), params)
+        else:
+            self._user_key_wrapkey = kdf.derive(pwd, salt, **params)
+            self._login_complete(params)
+
+    async def alogin(self, pwd):
+        pwd = pwd.encode('UTF-8')
+        salt = await sync_to_async(self.get_kdf_salt)()
+        params = kdf.get_params()
+
+        if self._user_key and self.kdf_params != params:
+            self._user_key_wrapkey = await kdf.aderive(pwd, salt, **self.kdf_params)
+            wrapkey = await kdf.aderive(pwd, salt, **params)
+            await sync_to_async(self._rewrap_user_key)(wrapkey, params)
+        else:
+            self._user_key_wrapkey = await kdf.aderive(pwd, salt, **params)
+            await sync_to_async(self._login_complete)(params)
+
+    def change_password(self, user_key, pwd, commit=True):
+        """Wrap user_key under a new password, after self.user's password was changed."""
+        params = kdf.get_params()
+        self._user_key_wrapkey = kdf.derive(pwd.encode('UTF-8'), self.get_kdf_salt(), **params)
+        self.user_key = user_key
+        self.kdf_params = params
+        if commit:
+            self.save(update_fields=['_user_key', 'kdf_opslimit', 'kdf_memlimit'])
+
+    def _login_complete(self, params):
         if not self._user_key:
-            self.generate_keys()
+            self.kdf_params = params
+        self.generate_keys()
+
+    def _rewrap_user_key(self, wrapkey, params):
+        user_key = self.user_key
+        self._user_key_wrapkey = wrapkey
+        self.user_key = user_key
+        self.kdf_params = params
+        self.save(update_fields=['_user_key', 'kdf_opslimit', 'kdf_memlimit'])
+        self.generate_keys()
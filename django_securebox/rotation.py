@@ -0,0 +1,148 @@
+"""Re-encryption of a user's permanent values with fresh object keys.
+
+Links are streamed in primary key order and rewritten in chunks, each in its
+own transaction. The last finished link is recorded on the UserSecureBox, so
+an interrupted rotation continues where it stopped. Each rewritten row is
+self-contained, so reads keep working while a rotation is in progress.
+Rows are locked and compared before they are written, so a value stored
+while its chunk was being re-encrypted is rotated again, not reverted.
+
+Rotation needs the user key and therefore the user's password. Transient
+values don't need rotation: changing ``SECRET_KEY`` simply invalidates them.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import nacl.exceptions
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+
+from django_securebox import cache, crypto, serializers
+
+
+def rotate_rows(user_key, rows, reencode=False):
+    """Re-encrypt (link pk, object pk, name, object_key, data) rows, skipping those that fail to decrypt."""
+    rotated = []
+    for link_pk, obj_pk, name, object_key, data in rows:
+        try:
+            plaintext = crypto.decrypt(crypto.decrypt(user_key, object_key), data)
+        except nacl.exceptions.CryptoError:
+            continue
+
+        if reencode:
+            plaintext = serializers.dumps(serializers.loads(plaintext))
+
+        object_key = crypto.generate_key()
+        rotated.append((
+            link_pk, obj_pk, name,
+            crypto.encrypt(user_key, object_key),
+            crypto.encrypt(object_key, plaintext),
+        ))
+    return rotated
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _rotated_chunks(user_key, chunks, reencode, workers):
+    """Yield (rows, rotated rows) for each chunk."""
+    if not workers:
+        for rows in chunks:
+            yield rows, rotate_rows(user_key, rows, reencode)
+        return
+
+    # Keep a bounded number of chunks in flight, in order
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for rows in chunks:
+            pending.append((rows, pool.submit(rotate_rows, user_key, rows, reencode)))
+            if len(pending) >= 2 * workers:
+                rows, future = pending.pop(0)
+                yield rows, future.result()
+        for rows, future in pending:
+            yield rows, future.result()
+
+
+def _locked_rows(link_pks):
+    """Current rows of the links, locked until the end of the transaction.
+
+    Links that were deleted or whose object got shared since are left out."""
+    from .models import SecureObjectLink
+
+    current = {
+        link_pk: (obj_pk, name, bytes(object_key), bytes(data))
+        for link_pk, obj_pk, name, object_key, data in SecureObjectLink.objects.select_for_update().filter(
+            pk__in=link_pks,
+        ).values_list('pk', 'obj_id', 'name', 'object_key', 'obj__data')
+    }
+    shared = set(SecureObjectLink.objects.filter(
+        obj_id__in=[obj_pk for obj_pk, _, _, _ in current.values()],
+    ).values('obj_id').annotate(
+        link_count=Count('pk'),
+    ).filter(
+        link_count__gt=1,
+    ).values_list('obj_id', flat=True))
+    return {link_pk: row for link_pk, row in current.items() if row[0] not in shared}
+
+
+def rotate_user(userbox, user_key, chunk_size=1000, workers=0, reencode=False):
+    """Give every value of userbox a fresh object key, returns the number of rotated values.
+
+    Objects that are linked more than once are skipped, since their object
+    key is wrapped for every link."""
+    from .models import SecureObject, SecureObjectLink
+
+    # Not an annotated Count, its GROUP BY would include every ciphertext before the first row is returned
+    rows = SecureObjectLink.objects.filter(
+        user_id=userbox.user_id,
+        pk__gt=userbox.rotation_checkpoint or 0,
+    ).filter(
+        ~Exists(SecureObjectLink.objects.filter(obj_id=OuterRef('obj_id')).exclude(pk=OuterRef('pk'))),
+    ).order_by('pk').values_list('pk', 'obj_id', 'name', 'object_key', 'obj__data')
+
+    # Database drivers may return memoryviews, which can't be sent to worker processes
+    rows = (
+        (link_pk, obj_pk, name, bytes(object_key), bytes(data))
+        for link_pk, obj_pk, name, object_key, data in rows.iterator(chunk_size=chunk_size)
+    )
+
+    rotated_count = 0
+    for chunk, rotated in _rotated_chunks(user_key, _chunks(rows, chunk_size), reencode, workers):
+        rotated = {row[0]: row for row in rotated}
+
+        with transaction.atomic():
+            current = _locked_rows([row[0] for row in chunk])
+            written, changed = [], []
+            for link_pk, *row in chunk:
+                if link_pk not in current:
+                    continue
+                if current[link_pk] != tuple(row):
+                    # Stored to since it was read, rotate what is there now
+                    changed.append((link_pk,) + current[link_pk])
+                elif link_pk in rotated:
+                    written.append(rotated[link_pk])
+            written += rotate_rows(user_key, changed, reencode)
+
+            SecureObjectLink.objects.bulk_update(
+                [SecureObjectLink(pk=link_pk, object_key=object_key) for link_pk, _, _, object_key, _ in written],
+                ['object_key'],
+            )
+            SecureObject.objects.bulk_update(
+                [SecureObject(pk=obj_pk, data=data) for _, obj_pk, _, _, data in written],
+                ['data'],
+            )
+            userbox.rotation_checkpoint = chunk[-1][0]
+            userbox.save(update_fields=['rotation_checkpoint'])
+        cache.invalidate(userbox.user_id, [name for _, _, name, _, _ in written])
+        rotated_count += len(written)
+
+    userbox.rotation_checkpoint = None
+    userbox.save(update_fields=['rotation_checkpoint'])
+    return rotated_count
@@ -0,0 +1,205 @@
+"""Serialization of stored values.
+
+Serialized values start with a one-byte tag naming their format, so values
+written under different ``SECUREBOX_SERIALIZER`` settings can be read side by
+side. Untagged values are pickles written by older versions; they start with
+the pickle PROTO opcode.
+
+The default is pickle, which round-trips any picklable value exactly; the
+other formats are opt-in. Values the configured serializer rejects with a
+TypeError or ValueError are pickled instead. Values it accepts but changes
+are not: JSON turns tuples into lists and int dict keys into strings, and
+marshal turns bytearrays into bytes. Marshal's format may also change
+between Python versions.
+
+Serialized values of at least ``threshold`` bytes can additionally be
+compressed, configured with ``SECUREBOX_COMPRESSION``, e.g.::
+
+    SECUREBOX_COMPRESSION = {'algorithm': 'zlib', 'threshold': 1024}
+
+Compressed values are prefixed with a tag naming the algorithm.
+
+Blob references always use their own format, whatever the setting, since
+formats like msgpack and JSON would turn them into plain lists.
+"""
+
+import json
+import lzma
+import marshal
+import pickle
+import struct
+import zlib
+
+from django.conf import settings
+
+from django_securebox import metrics
+from django_securebox.blobs import BlobReference
+from django_securebox.utils import SecureBoxException, SecureBoxFormatError
+
+LEGACY_PICKLE_TAG = b'\x80'
+
+
+class Serializer:
+    """dumps() returns bytes, loads() is passed a bytes-like object such as a memoryview."""
+    tag = None
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    tag = b'p'
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(Serializer):
+    tag = b'j'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(str(data, 'utf-8'))
+
+
+class MarshalSerializer(Serializer):
+    """Compact binary format for builtin types, only stable within a Python version."""
+    tag = b'm'
+
+    def dumps(self, value):
+        return marshal.dumps(value, 4)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    tag = b'M'
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class BlobReferenceSerializer(Serializer):
+    """blobs.BlobReference only, the blob's primary key and its stream key."""
+    tag = b'B'
+    pk = struct.Struct('>Q')
+
+    def dumps(self, value):
+        if not isinstance(value, BlobReference):
+            raise TypeError('blob reference serializer only handles BlobReference')
+        return self.pk.pack(value.pk) + value.key
+
+    def loads(self, data):
+        pk, = self.pk.unpack(data[:self.pk.size])
+        return BlobReference(pk, bytes(data[self.pk.size:]))
+
+
+class RawSerializer(Serializer):
+    """bytes only, stored as they are."""
+    tag = b'r'
+
+    def dumps(self, value):
+        if not isinstance(value, bytes):
+            raise TypeError('raw serializer only handles bytes')
+        return value
+
+    def loads(self, data):
+        return bytes(data)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer(),
+    'json': JSONSerializer(),
+    'marshal': MarshalSerializer(),
+    'raw': RawSerializer(),
+}
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    SERIALIZERS['msgpack'] = MsgpackSerializer()
+
+BLOB_REFERENCE_SERIALIZER = BlobReferenceSerializer()
+
+TAGS = {serializer.tag: serializer for serializer in SERIALIZERS.values()}
+TAGS[BLOB_REFERENCE_SERIALIZER.tag] = BLOB_REFERENCE_SERIALIZER
+
+COMPRESSORS = {
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+    'lzma': (b'x', lzma.compress, lzma.decompress),
+}
+
+COMPRESSION_TAGS = {tag: decompress for tag, _, decompress in COMPRESSORS.values()}
+
+
+def register(name, serializer):
+    if serializer.tag in TAGS or serializer.tag in COMPRESSION_TAGS or serializer.tag == LEGACY_PICKLE_TAG:
+        raise ValueError('Serializer tag {!r} is already in use'.format(serializer.tag))
+    SERIALIZERS[name] = serializer
+    TAGS[serializer.tag] = serializer
+
+
+def get_serializer():
+    name = getattr(settings, 'SECUREBOX_SERIALIZER', 'pickle')
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise SecureBoxException('Unknown SECUREBOX_SERIALIZER {!r}'.format(name))
+
+
+def compress(data):
+    config = getattr(settings, 'SECUREBOX_COMPRESSION', None)
+    if not config or len(data) < config.get('threshold', 0):
+        return data
+
+    try:
+        tag, compressor, _ = COMPRESSORS[config.get('algorithm', 'zlib')]
+    except KeyError:
+        raise SecureBoxException('Unknown SECUREBOX_COMPRESSION algorithm {!r}'.format(config['algorithm']))
+
+    compressed = tag + compressor(data)
+    return compressed if len(compressed) < len(data) else data
+
+
+def dumps(value):
+    with metrics.measure('serialize'):
+        serializer = BLOB_REFERENCE_SERIALIZER if isinstance(value, BlobReference) else get_serializer()
+        try:
+            data = serializer.tag + serializer.dumps(value)
+        except (TypeError, ValueError):
+            serializer = SERIALIZERS['pickle']
+            data = serializer.tag + serializer.dumps(value)
+        return compress(data)
+
+
+def loads(data):
+    with metrics.measure('deserialize'):
+        return _loads(data)
+
+
+def _loads(data):
+    data = memoryview(data)  # Strip the tag without copying the rest
+    tag = data[:1].tobytes()
+    if tag in COMPRESSION_TAGS:
+        return _loads(COMPRESSION_TAGS[tag](data[1:]))
+    if tag == LEGACY_PICKLE_TAG:
+        return pickle.loads(data)
+    try:
+        serializer = TAGS[tag]
+    except KeyError:
+        raise SecureBoxFormatError('Unknown serialization format {!r}'.format(tag))
+    return serializer.loads(data[1:])
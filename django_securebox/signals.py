@@ -1,13 +1,20 @@
-from django.contrib.auth import user_logged_in, user_logged_out
+from django.contrib.auth import logout, user_logged_in, user_logged_out
 from django.dispatch import receiver
 
 from .middleware import get_securebox
+from .utils import SecureBoxBusy
 
 
 @receiver(user_logged_in)
 def login_securebox(sender, signal, request, user, **kwargs):
     if 'password' in request.POST:
-        get_securebox(request).login(request.POST['password'])
+        try:
+            get_securebox(request).login(request.POST['password'])
+        except SecureBoxBusy:
+            # Don't leave a session behind whose box can't be opened, the
+            # middleware answers with 503 so the login can be retried
+            logout(request)
+            raise
 
 @receiver(user_logged_out)
 def logout_securebox(sender, signal, request, user, **kwargs):
@@ -0,0 +1,72 @@
+"""Where the ciphertexts of transient values are kept.
+
+By default they live in the session. With ``SECUREBOX_TRANSIENT_CACHE`` set
+to a cache alias they are kept in that cache instead and the session only
+holds the index of names, which keeps the session small. Cache entries are
+keyed by a random id stored in the session rather than by the session key,
+which changes on login.
+"""
+
+import nacl.encoding
+import nacl.hash
+import nacl.utils
+from django.conf import settings
+from django.core.cache import caches
+
+from django_securebox.utils import session_binary_get, session_binary_set
+
+STORE_ID_KEY = '_django_securebox_transient_id'
+
+
+class SessionTransientStore:
+    def __init__(self, request):
+        self.request = request
+
+    def get_many(self, names):
+        data = {}
+        for name in names:
+            if name in self.request.session:
+                data[name] = session_binary_get(self.request, name)
+        return data
+
+    def set(self, name, data):
+        session_binary_set(self.request, name, data)
+
+    def delete_many(self, names):
+        for name in names:
+            self.request.session.pop(name, None)
+
+
+class CacheTransientStore:
+    def __init__(self, request, alias):
+        self.request = request
+        self.cache = caches[alias]
+
+    def cache_key(self, name):
+        if STORE_ID_KEY not in self.request.session:
+            self.request.session[STORE_ID_KEY] = nacl.encoding.HexEncoder.encode(
+                nacl.utils.random(16)
+            ).decode('us-ascii')
+        # Names are hashed to keep keys short and free of characters memcached rejects
+        return 'django_securebox:transient:{}:{}'.format(
+            self.request.session[STORE_ID_KEY],
+            nacl.hash.blake2b(name.encode('utf-8'), digest_size=16).decode('us-ascii'),
+        )
+
+    def get_many(self, names):
+        cache_keys = {self.cache_key(name): name for name in names}
+        data = self.cache.get_many(list(cache_keys))
+        return {cache_keys[cache_key]: value for cache_key, value in data.items()}
+
+    def set(self, name, data):
+        self.cache.set(self.cache_key(name), data, timeout=settings.SESSION_COOKIE_AGE)
+
+    def delete_many(self, names):
+        self.cache.delete_many([self.cache_key(name) for name in names])
+
+
+def get_store(request):
+    alias = getattr(settings, 'SECUREBOX_TRANSIENT_CACHE', None)
+    if alias is None:
+        return SessionTransientStore(request)
+    return CacheTransientStore(request, alias)
@@ -1,11 +1,18 @@
-import pickle
+import time
 from contextlib import suppress
+from datetime import datetime, timedelta
 from enum import Enum
+from itertools import islice
 
 import nacl
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from django.utils.functional import SimpleLazyObject
 
+from django_securebox import crypto, metrics
+
 
 def session_binary_get(request, key):
     return nacl.encoding.Base64Encoder.decode(request.session[key])
@@ -17,6 +24,8 @@ COOKIE_KEY = 'django_securebox_cookie_key'
 SALT_KEY = '_django_securebox_salt'
 USER_KEY = '_django_securebox_user_key'
 TRANSIENT_KEY = '_django_securebox_transient_keys'
+TRANSIENT_EXPIRY_KEY = '_django_securebox_transient_expiry'
+TRANSIENT_VAULT_KEY = '_django_securebox_transient_vault'
 COOKIE_KEY_SIZE = 32
 
 class Storage(Enum):
@@ -42,15 +51,80 @@ class SecureBox:
         self.request = request
         self.set_cookies = {}
         self.delete_cookies = set()
-
+        self._session_keys = {}
+        self._session_keys_context = None
+        # Serialized plaintext by (Storage.TRANSIENT_ONLY or Storage.PERMANENT_ONLY, name),
+        # loaded on every hit so callers never share a mutable value
+        self._value_cache = {}
+        self.value_cache_stats = {'hits': 0, 'misses': 0}
+
+        # Only resolved (and created) when key material is needed, reads and
+        # writes of values filter links by user id instead
+        self.userbox = SimpleLazyObject(self._get_userbox)
+
+    def _get_userbox(self):
         from .models import UserSecureBox
-        self.userbox = SimpleLazyObject(lambda: UserSecureBox.objects.get_or_create(user=self.request.user)[0])
+
+        userbox, _ = UserSecureBox.objects.get_or_create(user_id=self.request.user.pk)
+        userbox.user = self.request.user  # Saves a query for the password hash
+        return userbox
+
+    def _links(self):
+        from .models import SecureObjectLink
+        return SecureObjectLink.objects.filter(user_id=self.request.user.pk)
+
+    def _live_links(self):
+        """Links that haven't expired, without decrypting anything."""
+        return self._links().exclude(expires_at__lte=timezone.now())
+
+    def _has_user_key(self):
+        return hasattr(self, '_user_key') or USER_KEY in self.request.session
 
     def login(self, password):
         self.userbox.login(password)
+        self._login_complete()
+
+    async def alogin(self, password):
+        await sync_to_async(getattr)(self.userbox, 'pk')  # Resolve the lazy userbox off the event loop
+        await self.userbox.alogin(password)
+        await sync_to_async(self._login_complete)()
+
+    def _login_complete(self):
         self.user_key = self.userbox.user_key
 
+    def set_password(self, password):
+        """Change the user's password without losing stored values.
+
+        Rewraps the user key under the new password with one KDF run, then
+        saves the user and the box in one transaction, so a failed derivation
+        (e.g. SecureBoxBusy) leaves the old password in place. Transient values
+        are re-encrypted for the new session keys. Call
+        update_session_auth_hash() afterwards as usual."""
+        user_key = self.user_key
+        transient = dict(self._iter_values_transient(self._transient_names()))
+
+        user = self.request.user
+        old_password = user.password
+        user.set_password(password)  # The KDF salt is derived from the new hash
+        try:
+            self.userbox.change_password(user_key, password, commit=False)
+        except BaseException:
+            user.password = old_password
+            raise
+
+        with transaction.atomic():
+            user.save()
+            self.userbox.save(update_fields=['_user_key', 'kdf_opslimit', 'kdf_memlimit'])
+        self.user_key = user_key
+        for key, value in transient.items():
+            self._store_value_transient(key, value, expires_at=self._transient_expires_at(key))
+
     def logout(self):
+        self.transient_store.delete_many(self.request.session.pop(TRANSIENT_KEY, []) + [TRANSIENT_VAULT_KEY])
+        self.request.session.pop(TRANSIENT_EXPIRY_KEY, None)
+        self._transient_vault = {}
+        self._transient_vault_dirty = False
+        self._value_cache = {}
         self.delete_cookies.add(COOKIE_KEY)
         if SALT_KEY in self.request.session:
             del self.request.session[SALT_KEY]
@@ -58,6 +132,8 @@ class SecureBox:
             del self.request.session[USER_KEY]
 
     def process_response(self, response):
+        self._save_transient_vault()
+
         for key, value in self.set_cookies.items():
             ## FIXME Sane params
             response.set_cookie(key, value, max_age=5*365*24*60*60, httponly=True)
@@ -65,8 +141,39 @@ class SecureBox:
         for key in self.delete_cookies:
             response.delete_cookie(key)
 
+    def process_response_needs_io(self):
+        """Whether process_response() may block, so async callers run it in a thread."""
+        return (
+            getattr(self, '_transient_vault_dirty', False)
+            or getattr(settings, 'SECUREBOX_TRANSIENT_CACHE', None) is not None
+        )
+
 
     def get_session_key(self, *prefixes):
+        """Derived key for prefixes, memoized for the lifetime of this object.
+
+        The memo is dropped whenever one of the inputs besides the prefixes
+        (salt, cookie key, password hash, SECRET_KEY) changes."""
+        if self._session_key_context() != self._session_keys_context:
+            self._session_keys = {}
+
+        if prefixes not in self._session_keys:
+            with metrics.measure('derive'):
+                self._session_keys[prefixes] = self._derive_session_key(*prefixes)
+            # Deriving may have created the salt, so take the context afterwards
+            self._session_keys_context = self._session_key_context()
+
+        return self._session_keys[prefixes]
+
+    def _session_key_context(self):
+        return (
+            self.request.session.get(SALT_KEY),
+            self.cookie_key,
+            self.request.user.password,
+            settings.SECRET_KEY,
+        )
+
+    def _derive_session_key(self, *prefixes):
         data_items = [
             item.encode('utf-8')
             for item in prefixes + (
@@ -88,6 +195,47 @@ class SecureBox:
             digest_size=nacl.secret.SecretBox.KEY_SIZE,
         )
 
+    @property
+    def transient_store(self):
+        if not hasattr(self, '_transient_store'):
+            from .transient import get_store
+            self._transient_store = get_store(self.request)
+        return self._transient_store
+
+    @property
+    def transient_vault(self):
+        """All transient values in one encrypted map, if SECUREBOX_TRANSIENT_VAULT is set.
+
+        Maps names to serialized values. It is decrypted on first access and
+        written back once, from process_response(), if it was changed."""
+        if not hasattr(self, '_transient_vault'):
+            from . import serializers
+
+            self._transient_vault = {}
+            self._transient_vault_dirty = False
+            data = self.transient_store.get_many([TRANSIENT_VAULT_KEY]).get(TRANSIENT_VAULT_KEY)
+            if data is not None:
+                with suppress(nacl.exceptions.CryptoError):
+                    with metrics.measure('decrypt'):
+                        data = crypto.decrypt(self.get_session_key('vault'), data)
+                    self._transient_vault = serializers.loads(data)
+        return self._transient_vault
+
+    def _use_transient_vault(self):
+        return getattr(settings, 'SECUREBOX_TRANSIENT_VAULT', False)
+
+    def _save_transient_vault(self):
+        if not getattr(self, '_transient_vault_dirty', False):
+            return
+
+        from . import serializers
+
+        data = serializers.dumps(self._transient_vault)
+        with metrics.measure('encrypt'):
+            data = crypto.encrypt(self.get_session_key('vault'), data)
+        self.transient_store.set(TRANSIENT_VAULT_KEY, data)
+        self._transient_vault_dirty = False
+
     @property
     def session_salt(self):
         if not SALT_KEY in self.request.session:
@@ -114,10 +262,9 @@ class SecureBox:
     @property
     def user_key(self):
         if not hasattr(self, '_user_key'):
-            self._user_key = nacl.secret.SecretBox(
-                self.get_session_key('user_key')
-            ).decrypt(
-                session_binary_get(self.request, USER_KEY)
+            self._user_key = crypto.decrypt(
+                self.get_session_key('user_key'),
+                session_binary_get(self.request, USER_KEY),
             )
 
         return self._user_key
@@ -125,14 +272,16 @@ class SecureBox:
     @user_key.setter
     def user_key(self, value):
         session_binary_set(self.request, USER_KEY, 
-            nacl.secret.SecretBox(
-                self.get_session_key('user_key')
-            ).encrypt(
-                value
-            )
+            crypto.encrypt(self.get_session_key('user_key'), value)
         )
         self._user_key = value
 
+    @property
+    def private_key(self):
+        if not hasattr(self, '_private_key'):
+            self._private_key = self.userbox.get_private_key(self.user_key)
+        return self._private_key
+
     def __setitem__(self, key, value):
         self.store_value(key, value, storage=Storage.TRANSIENT_OR_PERMANENT)
 
@@ -153,27 +302,40 @@ class SecureBox:
             return False
 
     def __iter__(self):
-        return self.keys()
+        return iter(self.keys())
 
     def keys(self):
+        """Names of all stored values.
+
+        Only looks at metadata, values are not decrypted. A name may therefore
+        be listed even if its value can no longer be decrypted."""
         return list(
-            set(
-                key for key in self.request.session.get(TRANSIENT_KEY, [])
-                if self.has_key(key)
-            ).union(set(
-                link_obj.name for link_obj in self.userbox.user.secure_objects.all()
-                if self.has_key(link_obj.name)  # FIXME Optimize
-            ))
+            set(self._transient_names()).union(
+                self._live_links().values_list('name', flat=True)
+            )
         )
 
     def items(self):
-        for name in self.keys():
-            with suppress(KeyError):
-                yield (name, self[name])  # FIXME Optimize
+        """Yield (name, value) for all values that can be decrypted.
+
+        Each value is decrypted exactly once, permanent values are streamed
+        from a single query. Transient values take precedence, as in
+        ``__getitem__``."""
+        seen = set()
+        for name, value in self._iter_values_transient(self._transient_names()):
+            seen.add(name)
+            yield (name, value)
+
+        for name, value in self._iter_values_permanent(self._live_links().select_related('obj').iterator()):
+            if name not in seen:
+                yield (name, value)
 
     def get(self, key, default=Ellipsis):
         return self.fetch_value(key, default=default)
 
+    def get_many(self, keys, storage=Storage.TRANSIENT_OR_PERMANENT):
+        return self.fetch_values(keys, storage=storage)
+
     def fetch_value(self, key, storage=Storage.TRANSIENT_OR_PERMANENT, default=Ellipsis):
         if storage in (Storage.TRANSIENT_OR_PERMANENT, Storage.TRANSIENT_ONLY):
             with suppress(KeyError):
@@ -192,66 +354,290 @@ class SecureBox:
         else:
             return default
 
-    def store_value(self, key, value, storage=Storage.PERMANENT_OR_TRANSIENT):
+    def fetch_values(self, keys, storage=Storage.TRANSIENT_OR_PERMANENT):
+        """Fetch several values at once.
+
+        Returns a dict of the keys that could be found, missing keys are left
+        out. Transient keys are resolved in one pass over the session, permanent
+        keys with one query."""
+        keys = list(keys)
+        values = {}
+
+        if storage in (Storage.TRANSIENT_OR_PERMANENT, Storage.TRANSIENT_ONLY):
+            values.update(self._fetch_values_transient(keys))
+
+        if storage in (Storage.TRANSIENT_OR_PERMANENT, Storage.PERMANENT_ONLY, Storage.PERMANENT_OR_TRANSIENT):
+            values.update(self._fetch_values_permanent([key for key in keys if key not in values]))
+
+        if storage is Storage.PERMANENT_OR_TRANSIENT:
+            values.update(self._fetch_values_transient([key for key in keys if key not in values]))
+
+        return values
+
+    def store_value(self, key, value, storage=Storage.PERMANENT_OR_TRANSIENT, ttl=None):
+        """Store value under key, ttl (seconds or a timedelta) lets it expire.
+
+        Storing a value again without ttl removes its expiry."""
+        link_obj = Ellipsis  # Not looked up yet
+        expires_at = _expires_at(ttl)
+
         if storage is Storage.TRANSIENT_OR_PERMANENT:
-            if self._store_value_transient(key, value, update_only=True):
+            if self._store_value_transient(key, value, update_only=True, expires_at=expires_at):
                 return
-            if self._store_value_permanent(key, value, update_only=True):
+            if self._store_value_permanent(key, value, update_only=True, expires_at=expires_at):
                 return
 
         elif storage is Storage.PERMANENT_OR_TRANSIENT:
-            if self._store_value_permanent(key, value, update_only=True):
+            link_obj = self._get_link(key)
+            if link_obj and self._store_value_permanent(key, value, update_only=True, link_obj=link_obj,
+                                                        expires_at=expires_at):
                 return
-            if self._store_value_transient(key, value, update_only=True):
+            if self._store_value_transient(key, value, update_only=True, expires_at=expires_at):
                 return
+            if link_obj:
+                # Could not be updated and may have been deleted, look it up again
+                link_obj = Ellipsis
 
         if storage in (Storage.TRANSIENT_OR_PERMANENT, Storage.TRANSIENT_ONLY):
-            self._store_value_transient(key, value)
+            self._store_value_transient(key, value, expires_at=expires_at)
 
             if storage is Storage.TRANSIENT_ONLY:
                 self.delete_value(key, storage=Storage.PERMANENT_ONLY)
 
         elif storage in (Storage.PERMANENT_OR_TRANSIENT, Storage.PERMANENT_ONLY):
             # TODO Test explicitly delete transient value
-            self._store_value_permanent(key, value)
+            self._store_value_permanent(key, value, link_obj=link_obj, expires_at=expires_at)
 
             if storage is Storage.PERMANENT_ONLY:
                 self.delete_value(key, storage=Storage.TRANSIENT_ONLY)
 
+    def store_many(self, values, storage=Storage.PERMANENT_OR_TRANSIENT, ttl=None):
+        """Store several values at once, with the same semantics as store_value().
+
+        Existing links are resolved with one query and permanent values are
+        written with bulk queries."""
+        values = dict(values)
+        expires_at = _expires_at(ttl)
+        link_objs = {}
+        if storage is not Storage.TRANSIENT_ONLY:
+            link_objs = {
+                link_obj.name: link_obj
+                for link_obj in _with_has_blobs(self._links().filter(name__in=values).select_related('obj'))
+            }
+
+        if storage is Storage.TRANSIENT_OR_PERMANENT:
+            transient = {
+                key: value for key, value in values.items()
+                if self._has_value_transient(key) or not self._has_value_permanent(key, link_objs)
+            }
+            permanent = {key: value for key, value in values.items() if key not in transient}
+        elif storage is Storage.PERMANENT_OR_TRANSIENT:
+            permanent = {
+                key: value for key, value in values.items()
+                if self._has_value_permanent(key, link_objs) or not self._has_value_transient(key)
+            }
+            transient = {key: value for key, value in values.items() if key not in permanent}
+        elif storage is Storage.TRANSIENT_ONLY:
+            transient, permanent = values, {}
+        else:
+            transient, permanent = {}, values
+
+        for key, value in transient.items():
+            self._store_value_transient(key, value, expires_at=expires_at)
+        if permanent:
+            self._store_values_permanent(permanent, link_objs, expires_at=expires_at)
+
+        if storage is Storage.TRANSIENT_ONLY:
+            self.delete_many(values, storage=Storage.PERMANENT_ONLY)
+        elif storage is Storage.PERMANENT_ONLY:
+            self.delete_many(values, storage=Storage.TRANSIENT_ONLY)
+
+    def _has_value_transient(self, key):
+        try:
+            self._fetch_value_transient(key)
+        except KeyError:
+            return False
+        return True
+
+    def _has_value_permanent(self, key, link_objs):
+        if key not in link_objs or link_objs[key].is_expired():
+            return False
+        if self._cached_values(Storage.PERMANENT_ONLY, [key])[0]:
+            return True
+        try:
+            self._accept_link(link_objs[key], self.user_key)
+            link_objs[key].get_plaintext(self.user_key)
+        except KeyError:
+            return False
+        except SecureBoxException:
+            del link_objs[key]  # get_data() deleted it
+            return False
+        return True
+
     def _fetch_value_transient(self, key):
-        if not key in self.request.session.get(TRANSIENT_KEY, []):
-            raise KeyError
+        return self._fetch_values_transient([key])[key]
+
+    def _fetch_values_transient(self, keys):
+        values, missing = self._cached_values(Storage.TRANSIENT_ONLY, keys)
+        values.update(self._iter_values_transient(missing))
+        return values
+
+    def _cached_values(self, storage, keys):
+        """Split keys into a dict of cached values and a list of keys that aren't cached."""
+        from . import serializers
+
+        values, missing = {}, []
+        for key in keys:
+            if (storage, key) in self._value_cache:
+                values[key] = serializers.loads(self._value_cache[(storage, key)])
+            else:
+                missing.append(key)
+        self.value_cache_stats['hits'] += len(values)
+        self.value_cache_stats['misses'] += len(missing)
+        return values, missing
+
+    def _transient_names(self):
+        """Names of the transient values, expired values are deleted first."""
+        expiry = self.request.session.get(TRANSIENT_EXPIRY_KEY)
+        if expiry:
+            now = time.time()
+            expired = {name for name, timestamp in expiry.items() if timestamp <= now}
+            if expired:
+                self._delete_values_transient(expired)
+        return self.request.session.get(TRANSIENT_KEY, [])
+
+    def _transient_expires_at(self, key):
+        timestamp = self.request.session.get(TRANSIENT_EXPIRY_KEY, {}).get(key)
+        return None if timestamp is None else datetime.fromtimestamp(timestamp, timezone.utc)
+
+    def _iter_values_transient(self, keys):
+        transient_keys = set(self._transient_names())
+        keys = [key for key in keys if key in transient_keys]
+        if not keys:
+            return
+
+        if self._use_transient_vault():
+            from . import serializers
+
+            for key in keys:
+                if key in self.transient_vault:
+                    data = self.transient_vault[key]
+                    value = serializers.loads(data)
+                    self._value_cache[(Storage.TRANSIENT_ONLY, key)] = data
+                    yield (key, value)
+            return
+
+        from . import serializers
+
+        ciphertexts = self.transient_store.get_many(keys)
+        for key in keys:
+            if key in ciphertexts:
+                try:
+                    data = self._decrypt_value_transient(key, ciphertexts[key])
+                except KeyError:
+                    continue
+                value = serializers.loads(data)
+                self._value_cache[(Storage.TRANSIENT_ONLY, key)] = data
+                yield (key, value)
+
+    def _decrypt_value_transient(self, key, data):
+        """Serialized value of the transient ciphertext data."""
         data_key = self.get_session_key("session", key)
-        with suppress(nacl.exceptions.CryptoError):
-            return pickle.loads(nacl.secret.SecretBox(data_key).decrypt(session_binary_get(self.request, key)))
-        raise KeyError
+        try:
+            with metrics.measure('decrypt'):
+                return crypto.decrypt(data_key, data)
+        except nacl.exceptions.CryptoError:
+            raise KeyError
 
-    def _store_value_transient(self, key, value, update_only=False):
+    def _store_value_transient(self, key, value, update_only=False, expires_at=None):
         if update_only:
             try:
                 self._fetch_value_transient(key)
             except KeyError:
                 return False
 
-        data_key = self.get_session_key("session", key)
-        session_binary_set(self.request, key,
-            nacl.secret.SecretBox(data_key).encrypt(pickle.dumps(value))
-        )
+        from . import serializers
+
+        data = serializers.dumps(value)
+        if self._use_transient_vault():
+            self.transient_vault[key] = data
+            self._transient_vault_dirty = True
+        else:
+            data_key = self.get_session_key("session", key)
+            with metrics.measure('encrypt'):
+                ciphertext = crypto.encrypt(data_key, data)
+            self.transient_store.set(key, ciphertext)
+        self._value_cache[(Storage.TRANSIENT_ONLY, key)] = data
         transient_list = self.request.session.get(TRANSIENT_KEY, [])
         if not key in transient_list:
             transient_list.append(key)
             self.request.session[TRANSIENT_KEY] = transient_list
+
+        expiry = self.request.session.get(TRANSIENT_EXPIRY_KEY, {})
+        if expires_at is not None:
+            expiry[key] = expires_at.timestamp()
+            self.request.session[TRANSIENT_EXPIRY_KEY] = expiry
+        elif key in expiry:
+            del expiry[key]
+            self.request.session[TRANSIENT_EXPIRY_KEY] = expiry
         return True
 
     def _fetch_value_permanent(self, key):
-        link_obj = self.userbox.user.secure_objects.filter(name=key).first()
-        if link_obj:
-            with suppress(SecureBoxException):  # Just fail silently and return KeyError if decryption fails
-                return link_obj.get_data(self.user_key)
-        raise KeyError
+        return self._fetch_values_permanent([key])[key]
+
+    def _fetch_values_permanent(self, keys):
+        if not keys:
+            return {}
+
+        values, missing = self._cached_values(Storage.PERMANENT_ONLY, keys)
+        if not missing or not self._has_user_key():
+            return values
 
-    def _store_value_permanent(self, key, value, update_only=False):
-        link_obj = self.userbox.user.secure_objects.filter(name=key).first()
+        from . import cache
+
+        user_id = self.request.user.pk
+        link_objs = list(cache.get_links(user_id, missing).values())
+        missing = set(missing).difference(link_obj.name for link_obj in link_objs)
+        link_objs = [link_obj for link_obj in link_objs if not link_obj.is_expired()]
+        if missing:
+            fetched = list(self._live_links().filter(name__in=missing).select_related('obj'))
+            cache.set_links(user_id, fetched)
+            link_objs.extend(fetched)
+
+        values.update(self._iter_values_permanent(link_objs))
+        return values
+
+    def _iter_values_permanent(self, link_objs):
+        from . import serializers
+
+        link_key = None
+        for link_obj in link_objs:
+            if link_key is None:
+                try:
+                    link_key = self.user_key
+                except KeyError:
+                    return
+
+            try:
+                self._accept_link(link_obj, link_key)
+                data = link_obj.get_plaintext(link_key)
+            except SecureBoxException:  # Just fail silently and leave out the key if decryption fails
+                continue
+            value = serializers.loads(data)  # Values in a format not available here raise SecureBoxFormatError
+            self._value_cache[(Storage.PERMANENT_ONLY, link_obj.name)] = data
+            yield (link_obj.name, value)
+
+    def _accept_link(self, link_obj, link_key):
+        """Accept a link shared with share(), on its first use."""
+        if link_obj.sealed:
+            link_obj.accept(link_key, self.private_key)
+
+    def _get_link(self, key):
+        return _with_has_blobs(self._links().filter(name=key).select_related('obj')).first()
+
+    def _store_value_permanent(self, key, value, update_only=False, link_obj=Ellipsis, expires_at=None):
+        if link_obj is Ellipsis:
+            link_obj = self._get_link(key)
 
         try:
             link_key = self.user_key
@@ -262,44 +648,263 @@ class SecureBox:
                 raise
 
         if update_only:
-            if link_obj:
+            if not link_obj or link_obj.is_expired():
+                return False
+            if not self._cached_values(Storage.PERMANENT_ONLY, [key])[0]:
                 try:
-                    link_obj.get_data(link_key)
+                    self._accept_link(link_obj, link_key)
+                    link_obj.get_plaintext(link_key)
                 except SecureBoxException:
                     return False
-            else:
-                return False
 
         if not link_obj:
             from .models import SecureObject, SecureObjectLink
 
             obj = SecureObject()
-            link_obj = SecureObjectLink(obj=obj, user=self.userbox.user, name=key)
+            link_obj = SecureObjectLink(obj=obj, user_id=self.request.user.pk, name=key)
+        else:
+            self._accept_link(link_obj, link_key)
 
-        link_obj.set_data(link_key, value)
+        self._value_cache[(Storage.PERMANENT_ONLY, key)] = link_obj.set_data(link_key, value, expires_at=expires_at)
         return True
 
+    def _store_values_permanent(self, values, link_objs, expires_at=None):
+        from .models import SecureObject, SecureObjectLink
+
+        link_key = self.user_key
+        links_values = []
+        for key, value in values.items():
+            link_obj = link_objs.get(key)
+            if not link_obj:
+                link_obj = SecureObjectLink(obj=SecureObject(), user_id=self.request.user.pk, name=key)
+            else:
+                self._accept_link(link_obj, link_key)
+            links_values.append((link_obj, value))
+
+        serialized = SecureObjectLink.set_data_many(link_key, links_values, expires_at=expires_at)
+        for key, data in zip(values, serialized):
+            self._value_cache[(Storage.PERMANENT_ONLY, key)] = data
+
+    def share(self, key, users):
+        """Share the permanent value key with users, under the same name.
+
+        The object key is sealed to each recipient's public key and all links
+        are created with one query. Recipients accept the share on first use.
+        Users without a key pair yet and users that already have a value of
+        that name are skipped. Returns the users the value was shared with."""
+        from .models import SecureObjectLink, UserSecureBox
+
+        link_obj = self._get_link(key)
+        if not link_obj or link_obj.is_expired():
+            raise KeyError(key)
+        self._accept_link(link_obj, self.user_key)
+        try:
+            object_key = crypto.decrypt(self.user_key, link_obj.object_key)
+        except nacl.exceptions.CryptoError as e:
+            raise SecureBoxException('Internal CryptoError') from e
+
+        userboxes = UserSecureBox.objects.filter(
+            user__in=users,
+        ).exclude(
+            user=self.request.user,
+        ).exclude(
+            user__secure_objects__name=key,
+        ).exclude(
+            public_key=b'',
+        ).select_related('user')
+
+        links = [
+            SecureObjectLink(
+                obj_id=link_obj.obj_id,
+                user_id=userbox.user_id,
+                name=key,
+                object_key=nacl.public.SealedBox(nacl.public.PublicKey(bytes(userbox.public_key))).encrypt(object_key),
+                sealed=True,
+                expires_at=link_obj.expires_at,
+            )
+            for userbox in userboxes
+        ]
+        SecureObjectLink.objects.bulk_create(links)
+        return [userbox.user for userbox in userboxes]
+
+    def open_writer(self, key, **kwargs):
+        """File-like object to stream a large value into permanent storage.
+
+        The value is stored under key when the writer is closed."""
+        from .blobs import BlobWriter
+        return BlobWriter(self, key, **kwargs)
+
+    def open_reader(self, key):
+        """File-like object to stream a value written with open_writer()."""
+        from .blobs import BlobReader, BlobReference
+        from .models import SecureBlob
+
+        reference = self.fetch_value(key, storage=Storage.PERMANENT_ONLY)
+        if not isinstance(reference, BlobReference):
+            raise SecureBoxException('{!r} is not a blob'.format(key))
+        try:
+            # Looked up by its value rather than reference.pk, which changes on import_stream()
+            blob = SecureBlob.objects.get(obj__links__user_id=self.request.user.pk, obj__links__name=key)
+        except SecureBlob.DoesNotExist:
+            raise KeyError(key)
+        return BlobReader(blob, reference.key)
+
+    def _store_blob_reference(self, key, reference):
+        from .models import SecureBlob
+
+        with transaction.atomic():
+            self.store_value(key, reference, storage=Storage.PERMANENT_ONLY)
+            obj_id = self._get_link(key).obj_id
+            SecureBlob.objects.filter(obj_id=obj_id).exclude(pk=reference.pk).delete()
+            SecureBlob.objects.filter(pk=reference.pk).update(obj_id=obj_id)
+
+    def export_stream(self, key, chunk_size=1000):
+        """Yield an archive of all permanent values and blobs, encrypted with key.
+
+        key is 32 bytes. Values are exported without decrypting them, see the
+        archive module."""
+        from .archive import export_user
+        return export_user(self.request.user.pk, key, chunk_size=chunk_size)
+
+    def import_stream(self, key, stream, batch_size=1000):
+        """Import an archive from export_stream() from the file-like stream.
+
+        Returns the number of imported values. If the archive's box has a
+        different user key, it replaces this user's box and values, and the
+        user has to log in again."""
+        from .archive import import_user
+
+        count = import_user(self.request.user.pk, key, stream, batch_size=batch_size)
+        self._value_cache = {
+            cache_key: value for cache_key, value in self._value_cache.items()
+            if cache_key[0] is not Storage.PERMANENT_ONLY
+        }
+        return count
+
     def delete_value(self, key, storage=Storage.ALL):
+        self.delete_many([key], storage=storage)
+
+    def delete_many(self, keys, storage=Storage.ALL):
+        keys = set(keys)
+
         if storage in (Storage.PERMANENT_OR_TRANSIENT, Storage.PERMANENT_ONLY, Storage.ALL):
-            link_obj = self.userbox.user.secure_objects.filter(name=key).first()
-            if link_obj:
-                link_obj.obj.delete()
-                if storage is not Storage.ALL:
-                    return
+            deleted = self._delete_values_permanent(keys)
+            if storage is not Storage.ALL:
+                keys -= deleted
 
         if storage in (Storage.PERMANENT_OR_TRANSIENT, Storage.TRANSIENT_ONLY, Storage.TRANSIENT_OR_PERMANENT, Storage.ALL):
-            if key in self.request.session.get(TRANSIENT_KEY, []):
-                self.request.session[TRANSIENT_KEY].remove(key)
-                del self.request.session[key]
-                self.request.session.modified = True
-                if storage is not Storage.ALL:
-                    return
+            deleted = self._delete_values_transient(keys)
+            if storage is not Storage.ALL:
+                keys -= deleted
 
         if storage is Storage.TRANSIENT_OR_PERMANENT:
-            link_obj = self.userbox.user.secure_objects.filter(name=key).first()
-            if link_obj:
-                link_obj.obj.delete()
+            self._delete_values_permanent(keys)
+
+    def _delete_values_transient(self, keys):
+        transient_list = self.request.session.get(TRANSIENT_KEY, [])
+        deleted = keys.intersection(transient_list)
+        if deleted:
+            self.request.session[TRANSIENT_KEY] = [key for key in transient_list if key not in deleted]
+            expiry = self.request.session.get(TRANSIENT_EXPIRY_KEY)
+            if expiry and not deleted.isdisjoint(expiry):
+                self.request.session[TRANSIENT_EXPIRY_KEY] = {
+                    key: timestamp for key, timestamp in expiry.items() if key not in deleted
+                }
+            if self._use_transient_vault():
+                for key in deleted:
+                    self.transient_vault.pop(key, None)
+                self._transient_vault_dirty = True
+            else:
+                self.transient_store.delete_many(deleted)
+            for key in deleted:
+                self._value_cache.pop((Storage.TRANSIENT_ONLY, key), None)
+        return deleted
+
+    def _delete_values_permanent(self, keys):
+        if not keys:
+            return set()
+
+        from .models import SecureObject
+
+        link_objs = self._links().filter(name__in=keys)
+        links = list(link_objs.values_list('name', 'obj_id'))
+        if links:
+            from . import cache
+
+            # Objects shared with other users stay linked to them
+            link_objs.delete()
+            SecureObject.clean_orphaned([obj_id for _, obj_id in links])
+            cache.invalidate(self.request.user.pk, [name for name, _ in links])
+        for name, _ in links:
+            self._value_cache.pop((Storage.PERMANENT_ONLY, name), None)
+        return {name for name, _ in links}
+
+    # Async API: every call does all its ORM, session and crypto work in a
+    # single hop to a worker thread, no matter how many keys it touches.
+
+    async def afetch_value(self, key, storage=Storage.TRANSIENT_OR_PERMANENT, default=Ellipsis):
+        return await sync_to_async(self.fetch_value)(key, storage=storage, default=default)
+
+    async def afetch_values(self, keys, storage=Storage.TRANSIENT_OR_PERMANENT):
+        return await sync_to_async(self.fetch_values)(list(keys), storage=storage)
+
+    async def aget_many(self, keys, storage=Storage.TRANSIENT_OR_PERMANENT):
+        return await self.afetch_values(keys, storage=storage)
+
+    async def ahas_key(self, key, storage=Storage.TRANSIENT_OR_PERMANENT):
+        return await sync_to_async(self.has_key)(key, storage=storage)
+
+    async def akeys(self):
+        return await sync_to_async(self.keys)()
+
+    async def aitems(self, batch_size=100):
+        """items(), fetched in batches of batch_size from a thread."""
+        items = self.items()
+        next_batch = sync_to_async(lambda: list(islice(items, batch_size)))
+        try:
+            while True:
+                batch = await next_batch()
+                if not batch:
+                    return
+                for item in batch:
+                    yield item
+        finally:
+            await sync_to_async(items.close)()
+
+    async def astore_value(self, key, value, storage=Storage.PERMANENT_OR_TRANSIENT, ttl=None):
+        await sync_to_async(self.store_value)(key, value, storage=storage, ttl=ttl)
+
+    async def adelete_value(self, key, storage=Storage.ALL):
+        await sync_to_async(self.delete_value)(key, storage=storage)
+
+
+def _with_has_blobs(links):
+    """Annotate links with has_blobs, so overwriting a blob with a plain value deletes the blob."""
+    from django.db.models import Exists, OuterRef
+
+    from .models import SecureBlob
+
+    return links.annotate(has_blobs=Exists(SecureBlob.objects.filter(obj_id=OuterRef('obj_id'))))
+
+
+def _expires_at(ttl):
+    if ttl is None:
+        return None
+    if not isinstance(ttl, timedelta):
+        ttl = timedelta(seconds=ttl)
+    return timezone.now() + ttl
 
 
 class SecureBoxException(Exception):
     pass
+
+
+class SecureBoxBusy(SecureBoxException):
+    pass
+
+
+class SecureBoxFormatError(SecureBoxException):
+    """A value decrypted fine but is in a format this process can't read.
+
+    E.g. it was written with a serializer that isn't installed or registered
+    here. The stored value is left alone."""
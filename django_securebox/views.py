@@ -0,0 +1,29 @@
+from django.contrib.auth import update_session_auth_hash
+from django.contrib.auth.views import PasswordChangeView
+from django.views.generic.edit import FormView
+
+from .middleware import get_securebox
+
+
+class SecureBoxPasswordChangeMixin:
+    """Changes the password through SecureBox.set_password() in a password change view.
+
+    Django's views save the form, which changes the password behind the
+    box's back, so the next login can't unwrap the user key and resets the
+    box. If the session holds the user key of the form's user, the key is
+    rewrapped under the new password instead."""
+
+    password_field = 'new_password1'
+
+    def form_valid(self, form):
+        securebox = get_securebox(self.request)
+        if form.user == self.request.user and securebox._has_user_key():
+            securebox.set_password(form.cleaned_data[self.password_field])
+        else:
+            form.save()
+        update_session_auth_hash(self.request, form.user)
+        return FormView.form_valid(self, form)
+
+
+class SecureBoxPasswordChangeView(SecureBoxPasswordChangeMixin, PasswordChangeView):
+    pass
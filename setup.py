@@ -11,7 +11,7 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = [ 'django>=1.11', 'pynacl==1.4.*', ]
+requirements = [ 'django>=3.0', 'pynacl==1.4.*', ]
 
 setup_requirements = ['pytest-runner', ]
 
@@ -26,9 +26,9 @@ setup(
         'License :: OSI Approved :: GNU Lesser General Public License v3 or later (LGPLv3+)',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
     ],
     description="Djange SecureBox implementation -- encrypts data for a Django User, but allows for transparent access within a Session",
     install_requires=requirements,
@@ -37,7 +37,8 @@ setup(
     include_package_data=True,
     keywords='django_securebox',
     name='django_securebox',
-    packages=find_packages(include=['django_securebox', 'django_securebox.migrations']),
+    packages=find_packages(include=['django_securebox', 'django_securebox.*']),
+    python_requires='>=3.7',
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
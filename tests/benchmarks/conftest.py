@@ -0,0 +1,88 @@
+"""Wall time and query counts of the hot paths, compared against saved baselines.
+
+Environment variables:
+
+``SECUREBOX_BENCHMARK_LARGE=1``
+    Also run the cases with 10k entries.
+``SECUREBOX_BENCHMARK_SAVE=1``
+    Write the results to baselines.json instead of comparing against it.
+``SECUREBOX_BENCHMARK_MAX_SLOWDOWN=1.5``
+    Fail cases that are slower than the baseline by more than that factor.
+    Wall time depends on the machine, so it is only reported by default.
+
+Query counts are compared always: a case must not make more queries than
+its baseline. Baselines are kept per database vendor; run with
+``SECUREBOX_TEST_DATABASE=postgres`` to use a local Postgres, see
+tests/conftest.py.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+BASELINES = Path(__file__).with_name('baselines.json')
+
+_results = {}
+
+
+def _load_baselines():
+    if not BASELINES.exists():
+        return {}
+    return json.loads(BASELINES.read_text())
+
+
+@pytest.fixture(scope='session')
+def bench_results():
+    yield _results
+    if not _results:
+        return
+
+    baselines = _load_baselines()
+    vendor_baselines = baselines.get(connection.vendor, {})
+    print('\n{:<40} {:>10} {:>10} {:>8}'.format('benchmark ({})'.format(connection.vendor), 'ms', 'baseline', 'queries'))
+    for name, result in sorted(_results.items()):
+        baseline = vendor_baselines.get(name, {}).get('ms')
+        print('{:<40} {:>10.3f} {:>10} {:>8}'.format(
+            name, result['ms'], '-' if baseline is None else '{:.3f}'.format(baseline), result['queries'],
+        ))
+
+    if os.environ.get('SECUREBOX_BENCHMARK_SAVE'):
+        vendor_baselines.update(_results)
+        baselines[connection.vendor] = vendor_baselines
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+@pytest.fixture
+def bench(bench_results):
+    """Run func rounds times, record the fastest round and check it against the baseline.
+
+    setup is called before every round, outside of the measurement."""
+    def run(name, func, setup=None, rounds=5):
+        best, queries = None, None
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                result = func()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            queries = len(captured)
+
+        bench_results[name] = {'ms': round(best * 1000, 3), 'queries': queries}
+
+        baseline = _load_baselines().get(connection.vendor, {}).get(name)
+        if baseline is not None and not os.environ.get('SECUREBOX_BENCHMARK_SAVE'):
+            assert queries <= baseline['queries'], '{} made {} queries, baseline is {}'.format(
+                name, queries, baseline['queries'])
+            max_slowdown = os.environ.get('SECUREBOX_BENCHMARK_MAX_SLOWDOWN')
+            if max_slowdown:
+                assert best * 1000 <= baseline['ms'] * float(max_slowdown), '{} took {:.3f}ms, baseline is {}ms'.format(
+                    name, best * 1000, baseline['ms'])
+        return result
+    return run
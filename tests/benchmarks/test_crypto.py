@@ -0,0 +1,30 @@
+"""Per-value cost of crypto.decrypt() compared to nacl.secret.SecretBox."""
+
+import timeit
+
+import nacl.secret
+import pytest
+
+from django_securebox import crypto, serializers
+
+
+@pytest.mark.parametrize('size', [64, 4096, 1024 * 1024])
+def test_decrypt(size):
+    key = crypto.generate_key()
+    value = b'x' * size
+    # Databases may return memoryviews, which SecretBox needs copied to bytes
+    data = memoryview(bytes(nacl.secret.SecretBox(key).encrypt(serializers.RawSerializer.tag + value)))
+    assert nacl.secret.SecretBox(key).decrypt(bytes(crypto.encrypt(key, value))) == value
+
+    def secretbox():
+        return serializers.loads(nacl.secret.SecretBox(key).decrypt(bytes(data)))
+
+    def low_allocation():
+        return serializers.loads(crypto.decrypt(key, data))
+
+    assert secretbox() == low_allocation() == value
+
+    number = 20 if size > 100000 else 2000
+    before = min(timeit.repeat(secretbox, number=number, repeat=3)) / number
+    after = min(timeit.repeat(low_allocation, number=number, repeat=3)) / number
+    print('\ndecrypt {} bytes: {:.2f}us with SecretBox, {:.2f}us with crypto'.format(size, before * 1e6, after * 1e6))
@@ -0,0 +1,76 @@
+"""Wall time and query counts of login, fetch/store, keys/items and orphan cleanup."""
+
+import os
+
+import pytest
+
+from django_securebox.models import SecureObject
+from django_securebox.utils import COOKIE_KEY, SecureBox, Storage
+
+SIZES = [
+    10,
+    1000,
+    pytest.param(10000, marks=pytest.mark.skipif(
+        not os.environ.get('SECUREBOX_BENCHMARK_LARGE'), reason='SECUREBOX_BENCHMARK_LARGE not set',
+    )),
+]
+
+
+def new_box(securebox):
+    """The box of a following request in the same session."""
+    request = type('Request', (), {})()
+    request.session = securebox.request.session
+    request.COOKIES = {COOKIE_KEY: securebox.set_cookies[COOKIE_KEY]}
+    request.user = securebox.request.user
+    return SecureBox(request)
+
+
+def run_with_new_box(bench, name, securebox, func, rounds=5):
+    boxes = []
+    return bench(name, lambda: func(boxes[-1]), setup=lambda: boxes.append(new_box(securebox)), rounds=rounds)
+
+
+@pytest.mark.django_db
+def test_login(bench, securebox):
+    run_with_new_box(bench, 'login', securebox, lambda box: box.login('test_password'))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('storage', [Storage.TRANSIENT_ONLY, Storage.PERMANENT_ONLY], ids=['transient', 'permanent'])
+def test_fetch_store(bench, securebox, storage):
+    securebox.store_value('key', 'value', storage=storage)
+    name = storage.name.split('_')[0].lower()
+
+    run_with_new_box(bench, 'fetch_value[{}]'.format(name), securebox,
+                     lambda box: box.fetch_value('key', storage=storage))
+    run_with_new_box(bench, 'store_value[{}]'.format(name), securebox,
+                     lambda box: box.store_value('key', 'changed', storage=storage))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('size', SIZES)
+def test_keys_items(bench, securebox, size):
+    securebox.store_many({'k{}'.format(i): i for i in range(size)}, storage=Storage.PERMANENT_ONLY)
+    rounds = 5 if size < 10000 else 1
+
+    assert len(run_with_new_box(bench, 'keys[{}]'.format(size), securebox,
+                                lambda box: box.keys(), rounds=rounds)) == size
+    assert len(run_with_new_box(bench, 'items[{}]'.format(size), securebox,
+                                lambda box: list(box.items()), rounds=rounds)) == size
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('size', SIZES)
+def test_clean_orphaned(bench, securebox, size):
+    securebox.store_many({'k{}'.format(i): i for i in range(10)}, storage=Storage.PERMANENT_ONLY)
+    ids = []
+
+    def create_orphans():
+        ids[:] = [obj.pk for obj in SecureObject.objects.bulk_create(SecureObject(data=b'') for _ in range(size))]
+        if ids[0] is None:  # The backend doesn't return primary keys from bulk inserts
+            ids[:] = SecureObject.objects.filter(links=None).values_list('pk', flat=True)
+
+    bench('clean_orphaned[{}]'.format(size), SecureObject.clean_orphaned, setup=create_orphans, rounds=3)
+    bench('clean_orphaned_ids[{}]'.format(size), lambda: SecureObject.clean_orphaned(ids),
+          setup=create_orphans, rounds=3)
+    assert SecureObject.objects.count() == 10
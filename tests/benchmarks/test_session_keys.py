@@ -0,0 +1,68 @@
+"""Number of session key derivations performed by a typical request."""
+
+import pytest
+
+from django_securebox.utils import COOKIE_KEY, SecureBox, Storage
+
+
+def typical_request(session, cookies, user):
+    request = type('Request', (), {})()
+    request.session = session
+    request.COOKIES = cookies
+    request.user = user
+
+    box = SecureBox(request)
+    for i in range(5):
+        box['t{}'.format(i)] = i
+    for i in range(5):
+        box['t{}'.format(i)]
+    box.fetch_values(['t0', 't1', 'p0'])
+    box.store_value('p0', 'value', storage=Storage.PERMANENT_ONLY)
+    box.fetch_value('p0')
+    dict(box.items())
+    return box
+
+
+def count_derivations(monkeypatch, securebox, memoized):
+    calls = []
+    derive = SecureBox._derive_session_key
+
+    def counting_derive(self, *prefixes):
+        calls.append(prefixes)
+        return derive(self, *prefixes)
+
+    monkeypatch.setattr(SecureBox, '_derive_session_key', counting_derive)
+    if not memoized:
+        monkeypatch.setattr(SecureBox, 'get_session_key', counting_derive)
+
+    cookies = {COOKIE_KEY: securebox.set_cookies[COOKIE_KEY]}
+    typical_request(securebox.request.session, cookies, securebox.request.user)
+    monkeypatch.undo()
+    return len(calls)
+
+
+@pytest.mark.django_db
+def test_session_key_derivations(monkeypatch, securebox):
+    before = count_derivations(monkeypatch, securebox, memoized=False)
+    after = count_derivations(monkeypatch, securebox, memoized=True)
+    print('\nsession key derivations per request: {} without memo, {} with memo'.format(before, after))
+
+    # One per distinct prefix tuple: five transient names plus the user key
+    assert after == 6
+    assert after < before
+
+
+@pytest.mark.django_db
+def test_session_key_memo_invalidation(securebox):
+    key = securebox.get_session_key('session', 'x')
+    assert securebox.get_session_key('session', 'x') is key
+
+    securebox.request.user.set_password('other_password')
+    assert securebox.get_session_key('session', 'x') != key
+
+    securebox.cookie_key = b'\0' * 32
+    changed = securebox.get_session_key('session', 'x')
+    assert changed != key
+
+    securebox.logout()
+    assert securebox.get_session_key('session', 'x') != changed
@@ -1,6 +1,8 @@
+import os
 from pprint import pformat
 
 import django
+import nacl.pwhash
 import pytest
 from django.conf import settings
 from django.conf.urls import url
@@ -23,29 +25,76 @@ def user():
     yield user
     user.delete()
 
+def login_securebox(rf, user, password):
+    from django.contrib.sessions.backends.db import SessionStore
+    from django_securebox.utils import SecureBox
+
+    request = rf.get('/')
+    request.session = SessionStore()
+    request.user = user
+    box = SecureBox(request)
+    box.login(password)
+    return box
+
+@pytest.fixture
+def securebox(rf, user):
+    return login_securebox(rf, user, 'test_password')
+
+@pytest.fixture
+def make_securebox(rf):
+    """Creates another user and returns their logged in SecureBox."""
+    def make(username, password='other_password'):
+        other = get_user_model().objects.create(username=username)
+        other.set_password(password)
+        other.save()
+        return login_securebox(rf, other, password)
+    return make
+
 def test_view(request):
     response = "Test\n" + pformat(list(request.securebox.items()))
     return HttpResponse(response, content_type='text/plain')
 
+async def async_test_view(request):
+    await request.securebox.astore_value('async', 'value')
+    response = "Test\n" + pformat([item async for item in request.securebox.aitems()])
+    return HttpResponse(response, content_type='text/plain')
+
 def lazy_loginview(*args, **kwargs):  ## FIXME Is there a more elegant way to do this?
     from django.contrib.auth.views import LoginView
     v = LoginView.as_view()
     return v(*args, **kwargs)
 
+def lazy_password_change_view(*args, **kwargs):
+    from django_securebox.views import SecureBoxPasswordChangeView
+    v = SecureBoxPasswordChangeView.as_view(success_url='/test')
+    return v(*args, **kwargs)
+
 urlpatterns = (
     url('^login$', lazy_loginview, name='login'),
+    url('^password_change$', lazy_password_change_view, name='password_change'),
     url('^test$', test_view, name='test'),
+    url('^async_test$', async_test_view, name='async_test'),
 )
 
+# Postgres uses the usual libpq environment variables (PGHOST, PGUSER, ...)
+DATABASES = {
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'django_securebox.db',
+    },
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('PGDATABASE', 'django_securebox'),
+    },
+}
+
 def pytest_configure():
     settings.configure(
         DEBUG=True,
+        SECRET_KEY='test_secret_key',
         USE_TZ=True,
         DATABASES={
-            'default': {
-                'ENGINE': 'django.db.backends.sqlite3',
-                'NAME': 'django_securebox.db',
-            }
+            'default': DATABASES[os.environ.get('SECUREBOX_TEST_DATABASE', 'sqlite')],
         },
         INSTALLED_APPS=[
             'django.contrib.auth',
@@ -66,5 +115,9 @@ def pytest_configure():
             'django.contrib.auth.hashers.MD5PasswordHasher',
         ),
         AUTH_USER_MODEL='auth.User',
+        SECUREBOX_KDF={
+            'opslimit': nacl.pwhash.argon2id.OPSLIMIT_MIN,
+            'memlimit': nacl.pwhash.argon2id.MEMLIMIT_MIN,
+        },
         ROOT_URLCONF=urlpatterns,
     )
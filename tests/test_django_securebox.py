@@ -6,10 +6,7 @@
 import pytest
 from django.shortcuts import reverse
 
-ani = pytest.mark.xfail(reason='Anonymous user not implemented yet', strict=True)
-
 @pytest.mark.django_db
-@ani
 def test_always_present(client):
     a = client.get(reverse('test'))
     assert a.wsgi_request.securebox
@@ -22,3 +19,789 @@ def test_login_works(login_user, client, user):
     simple_response = client.get(reverse('test'))
     assert simple_response.wsgi_request.securebox
     assert not simple_response.cookies.get('django_securebox_cookie_key')
+
+@pytest.mark.django_db
+def test_async_view(login_user, client, user):
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+
+    login_user(client, user)
+    async_client = AsyncClient()
+    async_client.cookies = client.cookies
+
+    async def get():
+        return await async_client.get(reverse('async_test'))
+
+    response = async_to_sync(get)()
+    assert response.status_code == 200
+    assert b"('async', 'value')" in response.content
+    assert user.secure_objects.filter(name='async').exists()
+
+@pytest.mark.django_db
+def test_fetch_values(securebox, django_assert_num_queries):
+    from django_securebox.utils import Storage
+
+    securebox.store_value('a', 1, storage=Storage.PERMANENT_ONLY)
+    securebox.store_value('b', 2, storage=Storage.PERMANENT_ONLY)
+    securebox.store_value('c', 3, storage=Storage.TRANSIENT_ONLY)
+
+    with django_assert_num_queries(1):
+        assert securebox.get_many(['a', 'b', 'c', 'd']) == {'a': 1, 'b': 2, 'c': 3}
+
+    assert securebox.fetch_values(['a', 'c'], storage=Storage.TRANSIENT_ONLY) == {'c': 3}
+    assert securebox.fetch_values(['a', 'c'], storage=Storage.PERMANENT_ONLY) == {'a': 1}
+
+@pytest.mark.django_db
+def test_keys_and_items(securebox, django_assert_num_queries):
+    from django_securebox.utils import Storage
+
+    for i in range(5):
+        securebox.store_value('p{}'.format(i), i, storage=Storage.PERMANENT_ONLY)
+    securebox.store_value('t', 't', storage=Storage.TRANSIENT_ONLY)
+    securebox._store_value_transient('p0', 'shadowed')
+
+    with django_assert_num_queries(1):
+        assert sorted(securebox) == ['p0', 'p1', 'p2', 'p3', 'p4', 't']
+
+    with django_assert_num_queries(1):
+        assert dict(securebox.items()) == {'p0': 'shadowed', 'p1': 1, 'p2': 2, 'p3': 3, 'p4': 4, 't': 't'}
+
+@pytest.mark.django_db
+def test_login_kdf_pool(securebox, settings):
+    from django_securebox import kdf
+    from django_securebox.utils import SecureBoxBusy
+
+    settings.SECUREBOX_KDF_POOL = {'max_workers': 1, 'max_queue': 0, 'timeout': 0}
+    user_key = securebox.user_key
+
+    securebox.login('test_password')
+    assert securebox.user_key == user_key
+
+    pool = kdf.get_pool()
+    pool.acquire()
+    try:
+        with pytest.raises(SecureBoxBusy):
+            securebox.login('test_password')
+    finally:
+        pool.slots.release()
+
+def test_kdf_pool_cancelled_asubmit(settings):
+    import asyncio
+    from asgiref.sync import async_to_sync
+    from django_securebox import kdf
+
+    settings.SECUREBOX_KDF_POOL = {'max_workers': 1, 'max_queue': 0, 'timeout': 5}
+    pool = kdf.get_pool()
+    pool.acquire()
+
+    async def cancel_waiting():
+        task = asyncio.ensure_future(pool.asubmit(b'password', b'0' * 16))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        pool.slots.release()  # The waiting thread gets the slot after the cancellation
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    async_to_sync(cancel_waiting)()
+    pool.timeout = 1
+    pool.acquire()
+    pool.slots.release()
+
+@pytest.mark.django_db
+def test_login_kdf_pool_busy(login_user, client, user, settings):
+    from django_securebox import kdf
+
+    settings.SECUREBOX_KDF_POOL = {'max_workers': 1, 'max_queue': 0, 'timeout': 0}
+    pool = kdf.get_pool()
+    pool.acquire()
+    try:
+        response = login_user(client, user)
+    finally:
+        pool.slots.release()
+
+    assert response.status_code == 503
+    assert response['Retry-After']
+    assert '_auth_user_id' not in client.session
+
+@pytest.mark.django_db
+def test_alogin(securebox, settings):
+    from asgiref.sync import async_to_sync
+    from django_securebox.utils import USER_KEY
+
+    settings.SECUREBOX_KDF_POOL = {'max_workers': 1, 'max_queue': 1}
+    user_key = securebox.user_key
+    del securebox._user_key
+    del securebox.request.session[USER_KEY]
+
+    async_to_sync(securebox.alogin)('test_password')
+    assert securebox.user_key == user_key
+
+@pytest.mark.django_db
+def test_login_rehashes_outdated_kdf_params(securebox, settings):
+    from django_securebox.utils import Storage
+
+    securebox.store_value('a', 1, storage=Storage.PERMANENT_ONLY)
+    userbox = securebox.userbox
+    old_params = userbox.kdf_params
+    new_params = {'opslimit': old_params['opslimit'] + 1, 'memlimit': old_params['memlimit'] * 2}
+    settings.SECUREBOX_KDF = new_params
+
+    securebox.login('test_password')
+    userbox.refresh_from_db()
+    assert userbox.kdf_params == new_params
+
+    securebox.request.session.flush()
+    del securebox._user_key
+    securebox.login('test_password')
+    assert securebox.fetch_value('a', storage=Storage.PERMANENT_ONLY) == 1
+
+@pytest.mark.django_db
+def test_async_api(securebox):
+    from asgiref.sync import async_to_sync
+    from django_securebox.models import SecureObjectLink
+    from django_securebox.utils import Storage
+
+    async def run():
+        await securebox.astore_value('a', 1, storage=Storage.PERMANENT_ONLY)
+        await securebox.astore_value('b', 2, storage=Storage.TRANSIENT_ONLY)
+        assert await securebox.afetch_value('a') == 1
+        assert await securebox.afetch_values(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+        assert sorted(await securebox.akeys()) == ['a', 'b']
+        assert dict([item async for item in securebox.aitems(batch_size=1)]) == {'a': 1, 'b': 2}
+        await securebox.adelete_value('a')
+        assert not await securebox.ahas_key('a')
+        await securebox.astore_value('c', 3, storage=Storage.PERMANENT_ONLY, ttl=3600)
+
+    async_to_sync(run)()
+    assert SecureObjectLink.objects.get(name='c').expires_at is not None
+
+@pytest.mark.django_db
+def test_async_middleware_transient_cache(securebox, settings):
+    from asgiref.sync import async_to_sync
+    from django.core.management import call_command
+    from django.http import HttpResponse
+    from django_securebox.middleware import SecureBoxMiddleware
+    from django_securebox.utils import Storage
+
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'db': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'securebox_test_cache'},
+    }
+    settings.SECUREBOX_TRANSIENT_CACHE = 'db'
+    settings.SECUREBOX_TRANSIENT_VAULT = True
+    call_command('createcachetable', 'securebox_test_cache')
+
+    request = securebox.request
+    request._cached_securebox = securebox
+    securebox.store_value('a', 1, storage=Storage.TRANSIENT_ONLY)  # Written back from process_response()
+
+    async def view(request):
+        return HttpResponse()
+
+    middleware = SecureBoxMiddleware(view)
+    async_to_sync(middleware)(request)
+
+    del securebox._transient_vault
+    securebox._value_cache.clear()
+    assert securebox.fetch_value('a', storage=Storage.TRANSIENT_ONLY) == 1
+
+@pytest.mark.django_db
+def test_store_value_queries(securebox, django_assert_num_queries):
+    from django_securebox.utils import Storage
+
+    # Lookup, INSERT SecureObject, INSERT SecureObjectLink, plus the savepoint pair
+    with django_assert_num_queries(5):
+        securebox.store_value('a', 1)
+
+    # Lookup, UPDATE SecureObject, plus the savepoint pair
+    with django_assert_num_queries(4):
+        securebox.store_value('a', 2)
+
+    assert securebox.fetch_value('a', storage=Storage.PERMANENT_ONLY) == 2
+
+@pytest.mark.django_db
+def test_store_and_delete_many(securebox, django_assert_max_num_queries):
+    from django.db import connection
+    from django_securebox.utils import Storage
+
+    securebox.store_value('t', 't', storage=Storage.TRANSIENT_ONLY)
+    securebox.store_value('p', 'p', storage=Storage.PERMANENT_ONLY)
+
+    values = {'k{}'.format(i): i for i in range(20)}
+    values.update(t='t2', p='p2')
+    # Backends that can't return primary keys from bulk inserts save new objects one by one
+    inserts = 1 if connection.features.can_return_rows_from_bulk_insert else 20
+    with django_assert_max_num_queries(6 + inserts):
+        securebox.store_many(values)
+
+    assert securebox.fetch_values(['t'], storage=Storage.TRANSIENT_ONLY) == {'t': 't2'}
+    assert securebox.fetch_values(values) == values
+
+    securebox.store_many({'p': 'p3', 'k0': 'x'})
+    assert securebox.fetch_values(['p', 'k0']) == {'p': 'p3', 'k0': 'x'}
+
+    with django_assert_max_num_queries(6):
+        securebox.delete_many(values)
+    assert securebox.keys() == []
+
+@pytest.mark.parametrize('name', ['pickle', 'json', 'marshal', 'raw'])
+def test_serializers(name, settings):
+    import datetime
+    import pickle
+    from django_securebox import serializers
+
+    settings.SECUREBOX_SERIALIZER = name
+    for value in [b'bytes', {'a': [1, 'b']}, datetime.date(2018, 7, 21)]:
+        data = serializers.dumps(value)
+        assert serializers.loads(data) == value
+        assert data[:1] in serializers.TAGS
+
+    # Untagged values written by older versions
+    assert serializers.loads(pickle.dumps({'a': 1})) == {'a': 1}
+
+@pytest.mark.django_db
+def test_unknown_serializer_keeps_value(securebox, settings, monkeypatch):
+    from django_securebox import serializers
+    from django_securebox.models import SecureObject, SecureObjectLink
+    from django_securebox.utils import SecureBoxFormatError, Storage
+
+    class UpperSerializer(serializers.Serializer):
+        tag = b'U'
+
+        def dumps(self, value):
+            return value.upper().encode('utf-8')
+
+        def loads(self, data):
+            return str(data, 'utf-8')
+
+    monkeypatch.setitem(serializers.SERIALIZERS, 'upper', UpperSerializer())
+    monkeypatch.setitem(serializers.TAGS, b'U', serializers.SERIALIZERS['upper'])
+    settings.SECUREBOX_SERIALIZER = 'upper'
+    securebox.store_value('a', 'value', storage=Storage.PERMANENT_ONLY)
+    securebox._value_cache.clear()
+
+    # Read from a process where the serializer isn't registered
+    monkeypatch.delitem(serializers.TAGS, b'U')
+    with pytest.raises(SecureBoxFormatError):
+        securebox.fetch_value('a')
+    assert SecureObjectLink.objects.filter(name='a').exists()
+    assert SecureObject.objects.count() == 1
+
+    monkeypatch.setitem(serializers.TAGS, b'U', serializers.SERIALIZERS['upper'])
+    assert securebox.fetch_value('a') == 'VALUE'
+
+def test_default_serializer_is_exact():
+    from django_securebox import serializers
+
+    value = {1: (bytearray(b'x'), frozenset([2]))}
+    loaded = serializers.loads(serializers.dumps(value))
+    assert loaded == value
+    assert type(loaded[1][0]) is bytearray
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'lzma'])
+def test_compression(algorithm, settings):
+    from django_securebox import serializers
+
+    settings.SECUREBOX_COMPRESSION = {'algorithm': algorithm, 'threshold': 100}
+    small, large = 'x' * 10, 'x' * 10000
+
+    assert serializers.dumps(small) == serializers.SERIALIZERS['pickle'].tag + serializers.SERIALIZERS['pickle'].dumps(small)
+    data = serializers.dumps(large)
+    assert data[:1] == serializers.COMPRESSORS[algorithm][0]
+    assert len(data) < 1000
+    assert serializers.loads(data) == large
+
+@pytest.mark.django_db
+def test_transient_cache_store(securebox, settings):
+    from django_securebox.utils import Storage
+
+    settings.SECUREBOX_TRANSIENT_CACHE = 'default'
+
+    securebox.store_many({'a': 1, 'b': 'x' * 1000}, storage=Storage.TRANSIENT_ONLY)
+    assert 'a' not in securebox.request.session
+    assert securebox.fetch_values(['a', 'b']) == {'a': 1, 'b': 'x' * 1000}
+
+    securebox.delete_value('a')
+    assert securebox.keys() == ['b']
+
+    securebox.logout()
+    assert securebox.transient_store.get_many(['b']) == {}
+
+@pytest.mark.django_db
+def test_transient_vault(securebox, settings):
+    from django.http import HttpResponse
+    from django_securebox.utils import COOKIE_KEY, SecureBox, Storage
+
+    settings.SECUREBOX_TRANSIENT_VAULT = True
+    values = {'t{}'.format(i): i for i in range(10)}
+    securebox.store_many(values, storage=Storage.TRANSIENT_ONLY)
+    securebox.delete_value('t0')
+    securebox.process_response(HttpResponse())
+
+    request = securebox.request
+    request.COOKIES = {COOKIE_KEY: securebox.set_cookies[COOKIE_KEY]}
+    box = SecureBox(request)
+    del values['t0']
+    assert box.fetch_values(values) == values
+    assert list(box._session_keys) == [('vault',)]
+
+@pytest.mark.django_db
+def test_value_cache(securebox, django_assert_num_queries):
+    from django_securebox.utils import Storage
+
+    securebox.store_value('a', 1, storage=Storage.PERMANENT_ONLY)
+    securebox._value_cache.clear()
+
+    securebox['a']
+    with django_assert_num_queries(0):
+        assert securebox['a'] == 1
+        assert 'a' in securebox
+    assert securebox.value_cache_stats['hits'] >= 2
+
+    # Update check is answered from the cache: lookup and UPDATE plus savepoints
+    with django_assert_num_queries(4):
+        securebox.store_value('a', 2)
+    assert securebox['a'] == 2
+
+    securebox.logout()
+    assert securebox._value_cache == {}
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('storage', ['PERMANENT_ONLY', 'TRANSIENT_ONLY'])
+def test_value_cache_copies(securebox, storage):
+    from django_securebox.utils import Storage
+
+    storage = Storage[storage]
+    prefs = {'a': 1}
+    securebox.store_value('prefs', prefs, storage=storage)
+    prefs['a'] = 2
+    assert securebox['prefs'] == {'a': 1}
+
+    securebox['prefs']['a'] = 3
+    assert securebox['prefs'] == {'a': 1}
+
+    securebox.store_many({'prefs': prefs}, storage=storage)
+    prefs['a'] = 4
+    assert securebox['prefs'] == {'a': 2}
+
+@pytest.mark.django_db
+def test_ciphertext_cache(securebox, settings, django_assert_num_queries):
+    from django.core.cache import cache
+    from django_securebox.utils import Storage
+
+    settings.SECUREBOX_CACHE = 'default'
+    cache.clear()
+    securebox.store_many({'a': 1, 'b': 2}, storage=Storage.PERMANENT_ONLY)
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(['a', 'b']) == {'a': 1, 'b': 2}
+
+    securebox._value_cache.clear()
+    with django_assert_num_queries(0):
+        assert securebox.fetch_values(['a', 'b']) == {'a': 1, 'b': 2}
+
+    securebox.store_value('a', 3)
+    securebox._value_cache.clear()
+    assert securebox['a'] == 3
+
+    securebox.userbox.reset_user_key()
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(['a', 'b']) == {}
+
+@pytest.mark.django_db
+def test_clean_orphaned(securebox):
+    import datetime
+    from django.core.management import call_command
+    from django.utils import timezone
+    from django_securebox.models import SecureBlob, SecureObject
+    from django_securebox.utils import Storage
+
+    securebox.store_many({'a': 1, 'b': 2}, storage=Storage.PERMANENT_ONLY)
+    orphans = [SecureObject.objects.create(data=b'') for _ in range(5)]
+    with securebox.open_writer('blob') as writer:
+        writer.write(b'blob')
+    abandoned = timezone.now() - datetime.timedelta(days=2)
+    for _ in range(3):
+        SecureBlob.objects.create(header=b'', created_at=abandoned)
+    writing = SecureBlob.objects.create(header=b'')
+
+    SecureObject.clean_orphaned([orphans[0].pk], batch_size=1)
+    assert SecureObject.objects.count() == 7
+
+    call_command('securebox_clean_orphans', chunk_size=2)
+    assert SecureObject.objects.count() == 3
+    assert set(SecureBlob.objects.filter(obj=None)) == {writing}
+    assert securebox.fetch_values(['a', 'b']) == {'a': 1, 'b': 2}
+    assert securebox.open_reader('blob').read() == b'blob'
+
+@pytest.mark.django_db
+def test_rotate_keys(securebox, monkeypatch):
+    import io
+    from django.core.management import call_command
+    from django_securebox.models import SecureObjectLink
+    from django_securebox.utils import Storage
+
+    values = {'k{}'.format(i): i for i in range(5)}
+    securebox.store_many(values, storage=Storage.PERMANENT_ONLY)
+    before = dict(SecureObjectLink.objects.values_list('name', 'object_key'))
+
+    monkeypatch.setattr('sys.stdin', io.StringIO('test_password\n'))
+    call_command('securebox_rotate_keys', 'regular_user', password_stdin=True, chunk_size=2)
+
+    after = dict(SecureObjectLink.objects.values_list('name', 'object_key'))
+    assert all(bytes(before[name]) != bytes(after[name]) for name in values)
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(values) == values
+
+    securebox.userbox.refresh_from_db()
+    assert securebox.userbox.rotation_checkpoint is None
+
+@pytest.mark.django_db
+def test_rotate_keys_concurrent_store(securebox, monkeypatch):
+    from django_securebox import rotation
+    from django_securebox.models import SecureObjectLink
+    from django_securebox.utils import Storage
+
+    securebox.store_many({'a': 1, 'b': 2}, storage=Storage.PERMANENT_ONLY)
+    before = dict(SecureObjectLink.objects.values_list('name', 'object_key'))
+
+    rotate_rows = rotation.rotate_rows
+    calls = []
+
+    def store_while_rotating(user_key, rows, reencode=False):
+        rotated = rotate_rows(user_key, rows, reencode)
+        if not calls:
+            securebox.store_value('a', 'stored meanwhile')
+        calls.append(rows)
+        return rotated
+
+    monkeypatch.setattr(rotation, 'rotate_rows', store_while_rotating)
+    assert rotation.rotate_user(securebox.userbox, securebox.user_key) == 2
+    assert [name for _, _, name, _, _ in calls[1]] == ['a']  # Rotated again from the stored row
+
+    after = dict(SecureObjectLink.objects.values_list('name', 'object_key'))
+    assert all(bytes(before[name]) != bytes(after[name]) for name in before)
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(['a', 'b']) == {'a': 'stored meanwhile', 'b': 2}
+
+@pytest.mark.django_db
+def test_rotate_keys_skips_shared(securebox):
+    from django.contrib.auth import get_user_model
+    from django_securebox import rotation
+    from django_securebox.models import SecureObjectLink
+    from django_securebox.utils import Storage
+
+    securebox.store_many({'mine': 1, 'shared': 2}, storage=Storage.PERMANENT_ONLY)
+    shared = SecureObjectLink.objects.get(name='shared')
+    other = get_user_model().objects.create(username='other')
+    SecureObjectLink.objects.create(user=other, obj_id=shared.obj_id, name='shared', object_key=b'', sealed=True)
+
+    assert rotation.rotate_user(securebox.userbox, securebox.user_key) == 1
+    assert bytes(SecureObjectLink.objects.get(pk=shared.pk).object_key) == bytes(shared.object_key)
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('vault', [False, True])
+def test_set_password_keeps_values(securebox, settings, vault):
+    from django_securebox.models import SecureObjectLink
+    from django_securebox.utils import Storage
+
+    settings.SECUREBOX_TRANSIENT_VAULT = vault
+    securebox.store_value('p', 1, storage=Storage.PERMANENT_ONLY)
+    securebox.store_value('t', 2, storage=Storage.TRANSIENT_ONLY)
+
+    securebox.set_password('new_password')
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(['p', 't']) == {'p': 1, 't': 2}
+
+    securebox.request.session.flush()
+    del securebox._user_key
+    securebox.userbox.refresh_from_db()
+    securebox.login('new_password')
+    securebox._value_cache.clear()
+    assert securebox.fetch_values(['p']) == {'p': 1}
+    assert SecureObjectLink.objects.count() == 1
+
+@pytest.mark.django_db
+def test_password_change_view_keeps_values(securebox, login_user, client, user):
+    from django.test import Client
+    from django_securebox.utils import Storage
+
+    securebox.store_value('p', 1, storage=Storage.PERMANENT_ONLY)
+    public_key = bytes(securebox.userbox.public_key)
+
+    login_user(client, user)
+    response = client.post(reverse('password_change'), {
+        'old_password': 'test_password',
+        'new_password1': 'new_password',
+        'new_password2': 'new_password',
+    })
+    assert response.status_code == 302
+    assert b"('p', 1)" in client.get(reverse('test')).content  # Still logged in
+
+    client = Client()
+    client.post(reverse('login'), {'username': user.username, 'password': 'new_password'})
+    assert b"('p', 1)" in client.get(reverse('test')).content
+    user.secure_box.refresh_from_db()
+    assert bytes(user.secure_box.public_key) == public_key
+
+@pytest.mark.django_db
+def test_set_password_busy_keeps_old_password(securebox, settings):
+    from django_securebox import kdf
+    from django_securebox.utils import SecureBoxBusy, Storage
+
+    securebox.store_value('p', 1, storage=Storage.PERMANENT_ONLY)
+    settings.SECUREBOX_KDF_POOL = {'max_workers': 1, 'max_queue': 0, 'timeout': 0}
+    pool = kdf.get_pool()
+    pool.acquire()
+    try:
+        with pytest.raises(SecureBoxBusy):
+            securebox.set_password('new_password')
+    finally:
+        pool.slots.release()
+
+    user = securebox.request.user
+    assert user.check_password('test_password')
+    user.refresh_from_db()
+    assert user.check_password('test_password')
+
+    securebox.request.session.flush()
+    del securebox._user_key
+    securebox._value_cache.clear()
+    securebox.userbox.refresh_from_db()
+    securebox.login('test_password')
+    assert securebox.fetch_values(['p']) == {'p': 1}
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('serializer', ['pickle', 'json', 'marshal', 'msgpack', 'raw'])
+def test_blobs(securebox, settings, serializer):
+    import os
+    from django_securebox import serializers
+    from django_securebox.blobs import blob_response
+    from django_securebox.models import SecureBlob, SecureBlobChunk
+
+    if serializer not in serializers.SERIALIZERS:
+        pytest.skip('{} is not installed'.format(serializer))
+    settings.SECUREBOX_SERIALIZER = serializer
+    data = os.urandom(10000)
+    with securebox.open_writer('blob', chunk_size=1024) as writer:
+        writer.write(data[:5000])
+        writer.write(data[5000:])
+    assert SecureBlobChunk.objects.count() == 10
+
+    with securebox.open_reader('blob') as reader:
+        assert reader.read(10) == data[:10]
+        assert reader.read() == data[10:]
+    assert b''.join(blob_response(securebox, 'blob').streaming_content) == data
+
+    with securebox.open_writer('blob') as writer:
+        writer.write(b'replaced')
+    assert securebox.open_reader('blob').read() == b'replaced'
+    assert SecureBlob.objects.count() == 1
+
+    securebox.delete_value('blob')
+    assert SecureBlob.objects.count() == 0
+
+    for store in (lambda: securebox.store_value('blob', 'plain'), lambda: securebox.store_many({'blob': 'plain'})):
+        with securebox.open_writer('blob') as writer:
+            writer.write(b'blob')
+        store()
+        assert securebox['blob'] == 'plain'
+        assert SecureBlob.objects.count() == 0
+        assert SecureBlobChunk.objects.count() == 0
+
+@pytest.mark.django_db
+def test_blob_close_fails(securebox, monkeypatch):
+    from django_securebox.models import SecureBlob, SecureBlobChunk
+
+    writer = securebox.open_writer('blob')
+    writer.write(b'data')
+    monkeypatch.setattr(securebox, 'store_value', lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        writer.close()
+    assert SecureBlob.objects.count() == 0
+    assert SecureBlobChunk.objects.count() == 0
+
+@pytest.mark.django_db
+def test_share(securebox, make_securebox, django_assert_num_queries):
+    from django_securebox.models import SecureObject, SecureObjectLink
+    from django_securebox.utils import Storage
+
+    boxes = [make_securebox('other{}'.format(i)) for i in range(3)]
+    boxes[2].store_value('secret', 'mine', storage=Storage.PERMANENT_ONLY)
+
+    securebox.store_value('secret', 'shared', storage=Storage.PERMANENT_ONLY)
+    with django_assert_num_queries(3):  # Link, recipients, one INSERT
+        shared = securebox.share('secret', [box.request.user for box in boxes])
+    assert set(shared) == {boxes[0].request.user, boxes[1].request.user}
+    assert SecureObjectLink.objects.filter(sealed=True).count() == 2
+
+    assert boxes[0]['secret'] == 'shared'
+    assert boxes[2]['secret'] == 'mine'
+    assert SecureObjectLink.objects.filter(sealed=True).count() == 1
+
+    boxes[0].store_value('secret', 'changed')
+    securebox._value_cache.clear()
+    assert securebox['secret'] == 'changed'
+    assert boxes[1]['secret'] == 'changed'
+
+    securebox.delete_value('secret')
+    boxes[0]._value_cache.clear()
+    assert boxes[0]['secret'] == 'changed'
+    boxes[0].delete_value('secret')
+    boxes[1].delete_value('secret')
+    assert SecureObject.objects.count() == 1
+
+@pytest.mark.django_db
+def test_share_ciphertext_cache(securebox, make_securebox, settings):
+    from django.core.cache import cache
+    from django_securebox.utils import Storage
+
+    settings.SECUREBOX_CACHE = 'default'
+    cache.clear()
+    box = make_securebox('other')
+    other = box.request.user
+
+    securebox.store_value('secret', 'v1', storage=Storage.PERMANENT_ONLY)
+    securebox.share('secret', [other])
+    assert box['secret'] == 'v1'
+    securebox._value_cache.clear()
+    assert securebox['secret'] == 'v1'
+
+    box.store_value('secret', 'v2')
+    securebox._value_cache.clear()
+    assert securebox['secret'] == 'v2'
+
+    securebox.store_many({'secret': 'v3'})
+    box._value_cache.clear()
+    assert box['secret'] == 'v3'
+
+@pytest.mark.django_db
+def test_metrics(login_user, client, user, settings, monkeypatch):
+    from django_securebox import metrics
+
+    sunk, sent = [], []
+    monkeypatch.setattr(metrics, 'test_sink', lambda request, m: sunk.append(m), raising=False)
+    settings.SECUREBOX_METRICS = {'sink': 'django_securebox.metrics.test_sink', 'header': 'Server-Timing'}
+
+    def receiver(sender, request, metrics, **kwargs):
+        sent.append(metrics)
+    metrics.metrics_collected.connect(receiver)
+    try:
+        response = login_user(client, user)
+    finally:
+        metrics.metrics_collected.disconnect(receiver)
+
+    assert sent == sunk
+    assert sent[0].counts['kdf'] == 1
+    assert sent[0].counts['query'] > 0
+    assert 'securebox-kdf;desc="1x";dur=' in response['Server-Timing']
+    assert metrics.current() is None
+
+@pytest.mark.django_db
+def test_read_without_userbox(rf, user, django_assert_num_queries):
+    from django.contrib.sessions.backends.db import SessionStore
+    from django_securebox.models import UserSecureBox
+    from django_securebox.utils import SecureBox
+
+    request = rf.get('/')
+    request.session = SessionStore()
+    request.user = user
+    box = SecureBox(request)
+    with django_assert_num_queries(0):
+        assert box.get('a', None) is None
+        assert box.fetch_values(['a', 'b']) == {}
+    with django_assert_num_queries(1):
+        assert box.keys() == []
+    assert not UserSecureBox.objects.exists()
+
+@pytest.mark.django_db
+def test_export_import(securebox, tmp_path):
+    import io
+    import nacl.encoding
+    import nacl.utils
+    from django.core.management import call_command
+    from django_securebox.models import SecureObject
+    from django_securebox.utils import SecureBoxException, Storage
+
+    values = {'k{}'.format(i): i for i in range(5)}
+    securebox.store_many(values, storage=Storage.PERMANENT_ONLY)
+    with securebox.open_writer('blob', chunk_size=16) as writer:
+        writer.write(b'x' * 100)
+
+    key = nacl.utils.random(32)
+    archive = b''.join(securebox.export_stream(key, chunk_size=2))
+    securebox.delete_many(list(values) + ['blob'])
+    assert SecureObject.objects.count() == 0
+
+    assert securebox.import_stream(key, io.BytesIO(archive), batch_size=2) == 6
+    assert securebox.fetch_values(values) == values
+    assert securebox.open_reader('blob').read() == b'x' * 100
+    with pytest.raises(SecureBoxException):
+        securebox.import_stream(nacl.utils.random(32), io.BytesIO(archive))
+    with pytest.raises(SecureBoxException):
+        securebox.import_stream(key, io.BytesIO(archive[:-1]))
+    assert securebox.open_reader('blob').read() == b'x' * 100
+
+    key_file = tmp_path / 'key'
+    key_file.write_bytes(nacl.encoding.Base64Encoder.encode(key))
+    call_command('securebox_export', str(tmp_path), key_file=str(key_file))
+
+    securebox.userbox.reset_user_key()
+    call_command('securebox_import', str(tmp_path / 'regular_user.sbx'), key_file=str(key_file))
+
+    securebox.request.session.flush()
+    del securebox._user_key
+    securebox._value_cache.clear()
+    securebox.userbox.refresh_from_db()
+    securebox.login('test_password')
+    assert securebox.fetch_values(values) == values
+    assert securebox.open_reader('blob').read() == b'x' * 100
+
+def test_archive_records():
+    import io
+    import nacl.utils
+    from django_securebox import archive
+    from django_securebox.utils import SecureBoxException
+
+    for record in [
+        ('box', b'user', b'public', b'private', 2, 2 ** 40),
+        ('value', 'näme', b'key', True, 1234567890.5, b'data'),
+        ('value', 'name', b'key', False, None, b''),
+        ('blob', b'header'),
+        ('chunk', b'\x00' * 10),
+    ]:
+        data = archive.encode_record(record)
+        assert archive.decode_record(data) == record
+        with pytest.raises(SecureBoxException):
+            archive.decode_record(data[:-1])
+
+    with pytest.raises(SecureBoxException, match='version'):
+        list(archive.read_archive(nacl.utils.random(32), io.BytesIO(b'SECUREBOX1' + b'\x00' * 100)))
+
+@pytest.mark.django_db
+def test_ttl(securebox, django_assert_num_queries):
+    from django.core.management import call_command
+    from django_securebox.models import SecureObject, SecureObjectLink
+    from django_securebox.utils import TRANSIENT_EXPIRY_KEY, Storage
+
+    securebox.store_value('gone', 1, storage=Storage.PERMANENT_ONLY, ttl=-1)
+    securebox.store_many({'live': 2, 'forever': 3}, storage=Storage.PERMANENT_ONLY, ttl=3600)
+    securebox.store_value('forever', 3, storage=Storage.PERMANENT_ONLY)
+    securebox.store_value('t_gone', 4, storage=Storage.TRANSIENT_ONLY, ttl=-1)
+    securebox.store_value('t_live', 5, storage=Storage.TRANSIENT_ONLY, ttl=3600)
+    securebox._value_cache.clear()
+
+    with django_assert_num_queries(1):
+        assert sorted(securebox.keys()) == ['forever', 'live', 't_live']
+    assert dict(securebox.items()) == {'live': 2, 'forever': 3, 't_live': 5}
+    assert securebox.get('gone', None) is None
+    assert list(securebox.request.session[TRANSIENT_EXPIRY_KEY]) == ['t_live']
+    assert SecureObjectLink.objects.get(name='forever').expires_at is None
+
+    call_command('securebox_purge_expired', batch_size=1)
+    assert SecureObjectLink.objects.count() == 2
+    assert SecureObject.objects.count() == 2
+
+    securebox.store_value('live', 6, storage=Storage.PERMANENT_ONLY, ttl=-1)
+    securebox.store_value('live', 7)
+    securebox._value_cache.clear()
+    assert securebox['live'] == 7